@@ -0,0 +1,284 @@
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import migrate
+
+# Source schema as exported from Access, restricted to the tables and columns
+# migrate.py reads
+SOURCE_SCHEMA = '''
+    CREATE TABLE tblStudenten (Student_ID INTEGER, Stud_Vorname TEXT, Stud_Name TEXT, email TEXT, Telefon TEXT, Jahrgang TEXT);
+    CREATE TABLE "tblUniversität" (Uni_ID INTEGER, Student_ID INTEGER, Uni_Name TEXT, Ort TEXT, Land TEXT, Kontinent TEXT, Homepage_Uni TEXT, Abteilung TEXT, Homepage_Abteilung TEXT, "Zeitraum Aufenthalt" TEXT, "Studiengebühren" TEXT, "Höhe pro Semester" TEXT);
+    CREATE TABLE tblFinanzierung (Student_ID INTEGER, Finanzierung_Institution TEXT, Betrag TEXT, Fin_Amt TEXT, FinOrt TEXT, finEmail TEXT, Hinweise TEXT);
+    CREATE TABLE tblEinreise (Student_ID INTEGER, Visum TEXT, Kosten TEXT, Beantragung_Zeit TEXT, Botschaft_Name TEXT, BotOrt TEXT, Botschaft_Homepage TEXT, BotEmail TEXT, BotTelefon TEXT, Bemerkungen TEXT);
+    CREATE TABLE tblWohnung (Student_ID INTEGER, WohnungsArt INTEGER, "Wohnqualität" INTEGER, WohnKosten TEXT, WohnheimHomepage TEXT, WohnheimEmail TEXT, WohnheimTel TEXT, WohnHinweise TEXT);
+    CREATE TABLE tblImpfung (Student_ID INTEGER, Impfungsart TEXT, ImpfKosten TEXT, ImpfEinrichtung TEXT, ImpfStrasse TEXT, ImpfPLZ TEXT, ImpfOrt TEXT, ImpfTelefon TEXT, ImpfEmail TEXT, ImpfHinweise TEXT);
+    CREATE TABLE tblKurse (Uni_ID INTEGER, Kurs_Name TEXT, Kursverantwortlicher TEXT, Kursemail TEXT, "Prüfungsform" TEXT, Schwierigkeitsgrad INTEGER, KursHinweise TEXT, Praktika TEXT);
+    CREATE TABLE tblPraktikumsort (Praktikums_ID INTEGER, Student_ID INTEGER, Land TEXT, Kontinent TEXT, NameOrganisation TEXT, OrtPraktikum TEXT, Zeitraum TEXT, KonatktpersonPraktikum TEXT, EmailPraktikum TEXT, HomepagePraktikum TEXT);
+    CREATE TABLE tblPraktikumsarbeit (Praktikums_ID INTEGER, "BeschreibungTätigkeit" TEXT, ThemaPraktikum TEXT, SonstigeArbeiten TEXT, BewertungBetreuung TEXT, BewertungOrganisation TEXT, KommentarPraktikum TEXT);
+    CREATE TABLE tblPraktFinanzen (Student_ID INTEGER, PraktFinanzier INTEGER, "Höhe" TEXT, Hinweise TEXT, Praktikumsgehalt TEXT, Prakt_Homepage TEXT, Prakt_email TEXT);
+    CREATE TABLE tblPraktikumVisum (Student_ID INTEGER, P_Visum TEXT, P_Visumskosten TEXT, P_Botschaft TEXT, P_BotOrt TEXT, P_Beantragung_Zeit TEXT, Bemerkungen TEXT, P_Bot_Homepage TEXT, P_BotEmail TEXT, P_BotTelefon TEXT);
+    CREATE TABLE tblPraktikumWohnung (Student_ID INTEGER, WohnungsArt INTEGER, "Wohnqualität" INTEGER, WohnKosten TEXT, WohnheimHomepage TEXT, WohnheimEmail TEXT, WohnheimTel TEXT, WohnHinweise TEXT);
+    CREATE TABLE tblPraktikumImpfung (Student_ID INTEGER, PraktImpfungsart TEXT, PraktImpfKosten TEXT, PraktImpfEinrichtung TEXT, PraktImpfStrasse TEXT, PraktImpfPLZ TEXT, PraktImpfOrt TEXT, PraktImpfTelefon TEXT, PraktImpfEmail TEXT, PraktImpfHinweise TEXT);
+    CREATE TABLE tblLand (Land_ID TEXT, Name_Land TEXT);
+    CREATE TABLE tblKontinent (Kontinent_ID TEXT, Kontnent_Name TEXT);
+    CREATE TABLE lstWohnungsart (Wohnart_ID INTEGER, Wohnungsart TEXT);
+    CREATE TABLE lstFinanzierungsart (Finanzierungsart_ID INTEGER, FinanzierungsArt TEXT);
+'''
+
+CONTINENTS = [('EU', 'Europa'), ('NA', 'Nordamerika'), ('SA', 'Südamerika'), ('AS', 'Asien'), ('AF', 'Afrika'), ('OC', 'Ozeanien')]
+COUNTRIES = [('DE', 'Deutschland', 'EU'), ('FR', 'Frankreich', 'EU'), ('ES', 'Spanien', 'EU'), ('GB', 'Großbritannien', 'EU'),
+             ('SE', 'Schweden', 'EU'), ('US', 'USA', 'NA'), ('CA', 'Kanada', 'NA'), ('MX', 'Mexiko', 'NA'), ('BR', 'Brasilien', 'SA'),
+             ('AR', 'Argentinien', 'SA'), ('JP', 'Japan', 'AS'), ('CN', 'China', 'AS'), ('IN', 'Indien', 'AS'), ('ZA', 'Südafrika', 'AF'),
+             ('KE', 'Kenia', 'AF'), ('AU', 'Australien', 'OC'), ('NZ', 'Neuseeland', 'OC')]
+HOUSING_TYPES = [(1, 'Wohnheim'), (2, 'WG'), (3, 'Gastfamilie'), (4, 'Eigene Wohnung')]
+FINANCE_TYPES = [(1, 'Erasmus'), (2, 'DAAD'), (3, 'Auslands-BAföG'), (4, 'Eigenmittel')]
+WORDS = ('der die das und mit für eine sehr gut kurs uni praktikum betreuung wohnung stadt semester visum kosten miete '
+         'projekt team labor vorlesung prüfung bewerbung botschaft erfahrung empfehlen organisation sprache kultur').split()
+BOOLEANS = ['True', 'True', 'False', 'False', '', None]
+
+class SourceGenerator:
+    # Writes a synthetic source database with the fan-out of the real data:
+    # most students have one study stay and one internship, some have none
+    # or two, and each stay has a few child rows with free-text comments.
+    # The same seed and size always produce the same database.
+    def __init__(self, conn, seed=1):
+        self.conn = conn
+        self.random = random.Random(seed)
+        self.buffers = {}
+
+    def text(self, average_words):
+        # Free text with an exponential length distribution, like the comments
+        return ' '.join(self.random.choices(WORDS, k=int(self.random.expovariate(1 / average_words)) + 1))
+
+    def maybe(self, probability, value):
+        return value if self.random.random() < probability else None
+
+    def count(self, weights):
+        # Number of child rows, drawn with weights for 0, 1, 2, ...
+        return self.random.choices(range(len(weights)), weights)[0]
+
+    def add(self, table, values):
+        self.buffers.setdefault(table, []).append(values)
+
+    def flush(self):
+        for table, rows in self.buffers.items():
+            if rows:
+                self.conn.executemany(f'INSERT INTO "{table}" VALUES ({", ".join("?" * len(rows[0]))})', rows)
+                rows.clear()
+
+    def generate(self, students, chunk_size=10000):
+        conn, r = self.conn, self.random
+        conn.executescript(SOURCE_SCHEMA)
+        conn.executemany("INSERT INTO tblKontinent VALUES (?, ?)", CONTINENTS)
+        conn.executemany("INSERT INTO tblLand VALUES (?, ?)", [(code, name) for code, name, _ in COUNTRIES])
+        conn.executemany("INSERT INTO lstWohnungsart VALUES (?, ?)", HOUSING_TYPES)
+        conn.executemany("INSERT INTO lstFinanzierungsart VALUES (?, ?)", FINANCE_TYPES)
+
+        # About one partner university per 20 students, each with its courses
+        universities = []
+        for uni_id in range(1, max(students // 20, 10) + 1):
+            _, country, continent = r.choice(COUNTRIES)
+            universities.append((uni_id, f'Universität {uni_id}', f'Stadt {uni_id % 500}', country, dict(CONTINENTS)[continent],
+                                 f'https://uni{uni_id}.example.org', f'Fakultät {r.randint(1, 12)}', f'https://uni{uni_id}.example.org/fakultaet'))
+            for _ in range(self.count([2, 2, 3, 3, 2, 2, 1, 1])):
+                self.add('tblKurse', (uni_id, self.text(4), f'Prof. {self.text(1)}', self.maybe(0.7, f'kurs{uni_id}@example.org'),
+                                      r.choice(['Klausur', 'mündlich', 'Hausarbeit', None]), r.randint(1, 5), self.maybe(0.6, self.text(30)),
+                                      r.choice(BOOLEANS)))
+
+        praktikums_id = 0
+        for student_id in range(1, students + 1):
+            self.add('tblStudenten', (student_id, f'Vorname{student_id}', f'Nachname{student_id}', f'student{student_id}@example.org',
+                                      self.maybe(0.5, f'0176 {r.randint(1000000, 9999999)}'), str(r.randint(2005, 2024))))
+
+            for _ in range(self.count([3, 6, 1])):
+                uni_id, name, city, country, continent, website, department, department_website = r.choice(universities)
+                self.add('tblUniversität', (uni_id, student_id, name, city, country, continent, website, department, department_website,
+                                            r.choice(['WS', 'SS', 'WS+SS']), r.choice(BOOLEANS), self.maybe(0.4, str(r.randint(500, 15000)))))
+            for _ in range(self.count([4, 4, 2])):
+                self.add('tblFinanzierung', (student_id, r.choice(FINANCE_TYPES)[1], str(r.randint(100, 1000)), self.text(2),
+                                             self.maybe(0.7, self.text(1)), self.maybe(0.5, f'fin{student_id}@example.org'), self.maybe(0.6, self.text(25))))
+            for _ in range(self.count([5, 5])):
+                self.add('tblEinreise', (student_id, r.choice(BOOLEANS), str(r.randint(0, 300)), f'{r.randint(1, 12)} Wochen', self.text(2),
+                                         self.text(1), 'https://embassy.example.org', 'visa@example.org', '+1 555 0100', self.maybe(0.5, self.text(30))))
+            for _ in range(self.count([4, 5, 1])):
+                self.add('tblWohnung', (student_id, r.choice([1, 2, 3, 4, None]), r.randint(1, 5), str(r.randint(200, 1200)),
+                                        self.maybe(0.5, 'https://wohnheim.example.org'), self.maybe(0.4, 'wohnen@example.org'), None, self.maybe(0.7, self.text(40))))
+            for _ in range(self.count([7, 2, 1])):
+                self.add('tblImpfung', (student_id, self.text(1), str(r.randint(0, 150)), self.text(2), self.text(2), str(r.randint(10000, 99999)),
+                                        self.text(1), None, None, self.maybe(0.4, self.text(15))))
+
+            for _ in range(self.count([4, 5, 1])):
+                praktikums_id += 1
+                code, _, continent = r.choice(COUNTRIES)
+                # A few codes are empty or missing from tblLand, like in the real data
+                code = r.choices([code, '', 'XX'], [96, 2, 2])[0]
+                self.add('tblPraktikumsort', (praktikums_id, student_id, code, continent, f'Organisation {r.randint(1, max(students // 10, 10))}',
+                                              f'Stadt {r.randint(1, 500)}', r.choice(['3 Monate', '6 Monate', 'Sommer']), self.text(2),
+                                              self.maybe(0.6, f'praktikum{praktikums_id}@example.org'), self.maybe(0.6, 'https://firma.example.org')))
+                for _ in range(self.count([1, 8, 1])):
+                    self.add('tblPraktikumsarbeit', (praktikums_id, self.text(60), self.text(5), self.maybe(0.5, self.text(20)),
+                                                     r.choice(['1', '2', '3', '4', '5', '']), r.choice(['1', '2', '3', '4', '5', '']), self.maybe(0.6, self.text(50))))
+            for _ in range(self.count([5, 4, 1])):
+                self.add('tblPraktFinanzen', (student_id, r.choice([1, 2, 3, 4, None]), str(r.randint(0, 2000)), self.maybe(0.5, self.text(20)),
+                                              r.choice(BOOLEANS), None, None))
+            for _ in range(self.count([6, 4])):
+                self.add('tblPraktikumVisum', (student_id, r.choice(BOOLEANS), str(r.randint(0, 300)), self.text(2), self.text(1),
+                                               f'{r.randint(1, 12)} Wochen', self.maybe(0.4, self.text(25)), None, None, None))
+            for _ in range(self.count([5, 5])):
+                self.add('tblPraktikumWohnung', (student_id, r.choice([1, 2, 3, 4, None]), r.randint(1, 5), str(r.randint(200, 1200)),
+                                                 None, None, None, self.maybe(0.6, self.text(30))))
+            for _ in range(self.count([8, 2])):
+                self.add('tblPraktikumImpfung', (student_id, self.text(1), str(r.randint(0, 150)), self.text(2), self.text(2),
+                                                 str(r.randint(10000, 99999)), self.text(1), None, None, self.maybe(0.3, self.text(15))))
+
+            if student_id % chunk_size == 0:
+                self.flush()
+        self.flush()
+        conn.commit()
+
+def generate_source(path, students, seed=1):
+    conn = sqlite3.connect(path)
+    try:
+        SourceGenerator(conn, seed).generate(students)
+    finally:
+        conn.close()
+
+def count_rows(conn, tables):
+    return sum(conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in tables)
+
+def prepare_source(path, students, seed=1):
+    # Generates the source unless it is already cached at path. Returns the
+    # seconds it took, or None for a cached source.
+    if os.path.exists(path):
+        return None
+    start = time.perf_counter()
+    partial_path = f'{path}.partial'
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    generate_source(partial_path, students, seed)
+    os.replace(partial_path, path)
+    return round(time.perf_counter() - start, 3)
+
+def run_benchmark(source_path, engine='python', workers=1, dedupe=False, cards=False, search=False, export=False):
+    # Runs migrate.migrate() on the source and reports the stages from the
+    # Metrics it returns. Meant to run in a fresh process, so the peak memory
+    # is this run's own.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dest_path = os.path.join(tmp_dir, 'dest.sqlite')
+        export_path = os.path.join(tmp_dir, 'export.sqlite') if export else None
+        source_conn = sqlite3.connect(f'file:{source_path}?mode=ro', uri=True)
+        source_tables = [row[0] for row in source_conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        source_rows = count_rows(source_conn, source_tables)
+        source_conn.close()
+
+        # migrate() reports its progress on stdout, which would drown the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            metrics = migrate.migrate(source_path, dest_path, engine=engine, cards=cards, search=search, dedupe=dedupe,
+                                      workers=workers, export=export_path)
+        summary = metrics.summary()
+
+        run = {
+            'source_rows': source_rows,
+            'total_seconds': summary['total_seconds'],
+            'peak_memory_mib': migrate.peak_memory_mib(),
+            'dest_size_mib': round(os.path.getsize(dest_path) / (1024 * 1024), 2),
+            'stages': summary['stages'],
+            'steps': summary['steps'],
+        }
+        if export_path:
+            run['export_size_mib'] = round(os.path.getsize(export_path) / (1024 * 1024), 2)
+        return run
+
+def compare_with_baseline(results, baseline, tolerance):
+    # Returns a message for every stage that got slower than the baseline
+    # allows; sizes or stages that are not in the baseline are skipped
+    slowdowns = []
+    previous_runs = {run['students']: run for run in baseline.get('runs', [])}
+    for run in results['runs']:
+        previous = previous_runs.get(run['students'])
+        if previous is None:
+            continue
+        for name, stage in run['stages'].items():
+            before = previous['stages'].get(name)
+            # Stages that take a few milliseconds are too noisy to compare
+            if before is None or before['seconds'] < 0.05:
+                continue
+            ratio = stage['seconds'] / before['seconds']
+            if ratio > 1 + tolerance:
+                slowdowns.append(f"{run['students']} students, {name}: {before['seconds']:.2f}s -> {stage['seconds']:.2f}s ({ratio:.2f}x)")
+    return slowdowns
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark migrate.py on synthetic source databases.')
+    parser.add_argument('--students', type=int, nargs='+', default=[1000, 10000, 100000], help='source sizes to benchmark, in students')
+    parser.add_argument('--engine', choices=['python', 'sql'], default='python', help='migration engine to benchmark')
+    parser.add_argument('--workers', type=int, default=1, help='number of transform processes for the python engine')
+    parser.add_argument('--dedupe', action='store_true', help='benchmark with --dedupe')
+    parser.add_argument('--cards', action='store_true', help='also time building experience_cards')
+    parser.add_argument('--search', action='store_true', help='also time building the full-text search index')
+    parser.add_argument('--export', action='store_true', help='also time writing the compact viewer export')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic data')
+    parser.add_argument('--cache', metavar='DIR', help='keep the generated sources in DIR and reuse them on later runs')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='JSON file with the results to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown per stage before a run counts as slower (default 0.25 = 25%%)')
+    parser.add_argument('--generate', metavar='PATH', help='only write a synthetic source database of the first --students size to PATH')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.generate:
+        generate_source(args.generate, args.students[0], args.seed)
+        print(f"Wrote a synthetic source with {args.students[0]} students to {args.generate}")
+        return
+
+    options = {'engine': args.engine, 'workers': args.workers, 'dedupe': args.dedupe, 'cards': args.cards, 'search': args.search,
+               'export': args.export}
+    results = {'options': {**options, 'seed': args.seed}, 'python': sys.version.split()[0], 'sqlite': sqlite3.sqlite_version, 'runs': []}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_dir = args.cache or tmp_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        for students in args.students:
+            source_path = os.path.join(cache_dir, f'source-{students}-{args.seed}.sqlite')
+            # The source is generated and migrated in separate fresh processes,
+            # so the peak memory is the migration's own and not carried over
+            # from the generator or an earlier size
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                generate_seconds = executor.submit(prepare_source, source_path, students, args.seed).result()
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                run = executor.submit(run_benchmark, source_path, **options).result()
+            run = {'students': students, 'generate_seconds': generate_seconds, **run}
+            results['runs'].append(run)
+            stages = ', '.join(f"{name} {stage['seconds']:.2f}s" for name, stage in run['stages'].items())
+            peak_memory = f"{run['peak_memory_mib']:.1f} MiB" if run['peak_memory_mib'] is not None else 'unknown'
+            print(f"{students} students: {run['total_seconds']:.2f}s ({stages}), "
+                  f"{run['stages']['migrate']['rows_per_second']} rows/s, peak memory {peak_memory}")
+
+    if args.save_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved the results to {args.baseline}")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('options') != results['options']:
+        print(f"Warning: {args.baseline} was recorded with different options: {baseline.get('options')}")
+    slowdowns = compare_with_baseline(results, baseline, args.tolerance)
+    for slowdown in slowdowns:
+        print(f"Slower than the baseline: {slowdown}")
+    if slowdowns:
+        sys.exit(1)
+    print(f"No stage is more than {args.tolerance:.0%} slower than {args.baseline}")
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,25 @@
 
+import argparse
+import cProfile
+import hashlib
+import json
+import os
+import re
 import sqlite3
+import sys
+import tempfile
+import time
 import logging
+import multiprocessing
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 logging.basicConfig(filename='migration.log', level=logging.INFO, filemode='w',
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -28,6 +47,96 @@ def str_to_boolean(word):
         return False
     else: return None
 
+def entity_key(*values):
+    # Normalized (name, city, country) key used to recognise the same
+    # university or organisation across rows
+    return '|'.join(' '.join(str(value).split()).casefold() if value is not None else '' for value in values)
+
+# Destination tables whose row counts are recorded per stage
+METRIC_TABLES = ['users', 'universities', 'organisations', 'study_experiences', 'internship_experiences', 'courses', 'finances',
+                 'entry_regulations', 'housings', 'vaccinations', 'experience_cards', 'experience_search_docs',
+                 'migration_fingerprints', 'migration_manifest']
+
+class Metrics:
+    # Wall time, source rows read and destination rows written per stage of
+    # one run, the time spent in each step of the row loop, and how often a
+    # row fell back to a default (unresolved codes, unusable ratings, ...)
+    def __init__(self):
+        self.stages = {}
+        self.steps = Counter()
+        self.rows_read = Counter()
+        self.fallbacks = Counter()
+
+    @staticmethod
+    def table_counts(conn):
+        counts = {}
+        for table in METRIC_TABLES:
+            try:
+                counts[table] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            except sqlite3.OperationalError:
+                pass
+        return counts
+
+    @contextmanager
+    def stage(self, name, conn):
+        before, read_before = self.table_counts(conn), sum(self.rows_read.values())
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        after = self.table_counts(conn)
+        # Net change per table, so rows deleted by an incremental run count against it
+        written = {table: count - before.get(table, 0) for table, count in after.items() if count != before.get(table, 0)}
+        total = sum(written.values())
+        self.stages[name] = {
+            'seconds': round(seconds, 3),
+            'rows_read': sum(self.rows_read.values()) - read_before,
+            'rows_written': total,
+            'rows_per_second': round(total / seconds) if seconds else None,
+            'tables': {table: {'rows_written': count, 'rows_per_second': round(count / seconds) if seconds else None}
+                       for table, count in written.items()},
+        }
+
+    @contextmanager
+    def step(self, name):
+        start = time.perf_counter()
+        yield
+        self.steps[name] += time.perf_counter() - start
+
+    def read(self, table, count):
+        self.rows_read[table] += count
+
+    def read_chunk(self, table, rows, child_names, children):
+        self.read(table, len(rows))
+        for name in child_names:
+            self.read(CHILD_TABLES[name][0], sum(len(child_rows) for child_rows in children[name].values()))
+
+    def merge(self, rows_read, fallbacks):
+        # Adds the counts a --workers process collected for one task
+        self.rows_read.update(rows_read)
+        self.fallbacks.update(fallbacks)
+
+    def summary(self):
+        return {
+            'stages': self.stages,
+            'total_seconds': round(sum(stage['seconds'] for stage in self.stages.values()), 3),
+            'steps': {name: round(seconds, 3) for name, seconds in self.steps.items()},
+            'rows_read': dict(self.rows_read),
+            'fallbacks': dict(self.fallbacks),
+        }
+
+    def log(self):
+        for name, stage in self.stages.items():
+            logging.info("Stage %s: %.3fs, %d source rows read, %d rows written (%s rows/s)",
+                         name, stage['seconds'], stage['rows_read'], stage['rows_written'], stage['rows_per_second'])
+            for table, counts in stage['tables'].items():
+                logging.info("Stage %s: %d rows written to %s (%s rows/s)", name, counts['rows_written'], table, counts['rows_per_second'])
+        for name, seconds in self.steps.items():
+            logging.info("Step %s: %.3fs", name, seconds)
+        for table, count in self.rows_read.items():
+            logging.info("Read %d rows from %s", count, table)
+        for name, count in self.fallbacks.items():
+            logging.info("Fallback %s: %d rows", name, count)
+
 
 def create_tables(conn):
     cursor = conn.cursor()
@@ -94,10 +203,12 @@ def create_tables(conn):
             FOREIGN KEY(organisation_id) REFERENCES organisations(id)
         )
     ''')
+    # With --dedupe, courses are linked once to their university (study_experience_id is NULL)
+    # instead of being copied into every study experience at that university
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS courses (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            study_experience_id INTEGER NOT NULL,
+            study_experience_id INTEGER,
             title TEXT,
             responsible_person TEXT,
             exam_type TEXT,
@@ -105,7 +216,9 @@ def create_tables(conn):
             comments TEXT,
             email TEXT,
             practical_training BOOLEAN,
-            FOREIGN KEY(study_experience_id) REFERENCES study_experiences(id)
+            university_id INTEGER,
+            FOREIGN KEY(study_experience_id) REFERENCES study_experiences(id),
+            FOREIGN KEY(university_id) REFERENCES universities(id)
         )
     ''')
     # I dont migrate FinOrt, FinPostleizahl, FinStrasse from tblFinanzierung yet.
@@ -182,201 +295,1532 @@ def create_tables(conn):
     ''')
     conn.commit()
 
-def main():
-    source_conn = get_db_connection('databases/data.sqlite')
-    dest_conn = get_db_connection('abroad_experiences_migrated.sqlite')
+DEFAULT_CHUNK_SIZE = 1000
 
-    # Drop existing tables to start fresh
-    cursor = dest_conn.cursor()
-    tables = ['users', 'universities', 'organisations', 'study_experiences', 'internship_experiences', 'courses', 'finances', 'entry_regulations', 'housings', 'vaccinations']
-    for table in tables:
-        cursor.execute(f"DROP TABLE IF EXISTS {table}")
-    dest_conn.commit()
+def iter_chunks(conn, query, chunk_size=DEFAULT_CHUNK_SIZE, params=()):
+    # Streams a query result in fetchmany()-sized lists instead of one fetchall()
+    cursor = conn.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
 
-    create_tables(dest_conn)
+# Child tables are indexed once up front by the column their parent rows join
+# on (the parent tables use the same column names). The index only holds
+# source rowids; the rows themselves are fetched for one chunk of parent rows
+# at a time, so the free-text columns are never all in memory at once.
+CHILD_TABLES = {
+    'study_finances': ('tblFinanzierung', 'Student_ID'),
+    'study_entry_regulations': ('tblEinreise', 'Student_ID'),
+    'study_housings': ('tblWohnung', 'Student_ID'),
+    'study_vaccinations': ('tblImpfung', 'Student_ID'),
+    'courses': ('tblKurse', 'Uni_ID'),
+    'work_descriptions': ('tblPraktikumsarbeit', 'Praktikums_ID'),
+    'internship_finances': ('tblPraktFinanzen', 'Student_ID'),
+    'internship_entry_regulations': ('tblPraktikumVisum', 'Student_ID'),
+    'internship_housings': ('tblPraktikumWohnung', 'Student_ID'),
+    'internship_vaccinations': ('tblPraktikumImpfung', 'Student_ID'),
+}
+STUDY_CHILDREN = ['study_finances', 'study_entry_regulations', 'study_housings', 'study_vaccinations', 'courses']
+INTERNSHIP_CHILDREN = ['work_descriptions', 'internship_finances', 'internship_entry_regulations', 'internship_housings', 'internship_vaccinations']
 
-    source_cursor = source_conn.cursor()
-    dest_cursor = dest_conn.cursor()
+# Text that NUMERIC affinity turns into a number, with the whitespace SQLite skips
+NUMERIC_TEXT = re.compile(r'[ \t\n\v\f\r]*[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?[ \t\n\v\f\r]*')
 
-    # Migrate students (users)
-    source_cursor.execute("SELECT * FROM tblStudenten")
-    for row in source_cursor.fetchall():
-        dest_cursor.execute("INSERT INTO users (id, first_name, last_name, user_email, user_phone, class_year) VALUES (?, ?, ?, ?, ?, ?)",
-                            (row['Student_ID'], row['Stud_Vorname'], row['Stud_Name'], row['email'], row['Telefon'], row['Jahrgang']))
+def numeric_value(value):
+    # Converts text like SQLite's NUMERIC affinity does; other values and
+    # text that is not a well-formed number are returned unchanged
+    if not isinstance(value, str) or not NUMERIC_TEXT.fullmatch(value):
+        return value
+    text = value.strip(' \t\n\v\f\r')
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
 
+def text_value(value):
+    # Converts numbers like SQLite's TEXT affinity does
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return value
+    if isinstance(value, int):
+        return str(value)
+    text = f'{value:.15g}'
+    mantissa, _, exponent = text.partition('e')
+    if '.' not in mantissa and mantissa.lstrip('-').isdigit():
+        mantissa += '.0'
+    return f'{mantissa}e{exponent}' if exponent else mantissa
 
-    # Migrate study experiences
-    source_cursor.execute("SELECT * FROM tblUniversität")
-    for row in source_cursor.fetchall():
-
-        uni_id = int(row['Uni_ID'])
-        dest_cursor.execute("INSERT OR IGNORE INTO universities (id, name, city, country, continent, website, department, department_website) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                            (uni_id,
-                            row['Uni_Name'], 
-                            row['Ort'], 
-                            row['Land'], 
-                            row['Kontinent'], 
-                            row['Homepage_Uni'], 
-                            row['Abteilung'] ,
-                            row['Homepage_Abteilung']))
-        
-        dest_cursor.execute("INSERT INTO study_experiences (user_id, university_id, duration, study_fees, tuition_cost) VALUES (?, ?, ?, ?, ?)",
-                            (row['Student_ID'], uni_id, row['Zeitraum Aufenthalt'], row['Studiengebühren'] == 'True', row['Höhe pro Semester']))
-        study_exp_id = dest_cursor.lastrowid
+def column_affinity(conn, table, column):
+    # Affinity of a source column, from its declared type
+    declared = next((row[2] for row in conn.execute(f'PRAGMA table_info("{table}")') if row[1].lower() == column.lower()), '').upper()
+    if 'INT' in declared:
+        return 'INTEGER'
+    if any(name in declared for name in ('CHAR', 'CLOB', 'TEXT')):
+        return 'TEXT'
+    if 'BLOB' in declared or not declared:
+        return 'BLOB'
+    if any(name in declared for name in ('REAL', 'FLOA', 'DOUB')):
+        return 'REAL'
+    return 'NUMERIC'
+
+class ColumnIndex(dict):
+    # Maps the stored values of one source column to what they index. key()
+    # applies the column's affinity to a probed value, like "WHERE column = ?"
+    # does with its parameter, so a lookup matches exactly the rows the old
+    # per-row queries matched: INTEGER 5 finds TEXT '5' in an INTEGER column,
+    # but never '05' in a TEXT column or '5' in a column without a type.
+    def __init__(self, affinity='BLOB'):
+        super().__init__()
+        self.affinity = affinity
+
+    def key(self, value):
+        if self.affinity in ('INTEGER', 'REAL', 'NUMERIC'):
+            return numeric_value(value)
+        if self.affinity == 'TEXT':
+            return text_value(value)
+        return value
+
+def load_child_index(conn, table, key, chunk_size=DEFAULT_CHUNK_SIZE):
+    index = ColumnIndex(column_affinity(conn, table, key))
+    for rows in iter_chunks(conn, f"SELECT {key}, rowid FROM {table}", chunk_size):
+        for key_value, rowid in rows:
+            # NULL keys never matched the old "WHERE key = ?" lookups either
+            if key_value is not None:
+                index.setdefault(key_value, []).append(rowid)
+    return index
+
+def preload_children(conn, chunk_size=DEFAULT_CHUNK_SIZE):
+    return {name: load_child_index(conn, table, key, chunk_size) for name, (table, key) in CHILD_TABLES.items()}
+
+def load_chunk_children(conn, indexes, names, parent_rows):
+    # Fetches the child rows of one chunk of parent rows by rowid and groups
+    # them by join key, in the same order as the old per-row queries
+    chunk_children = {}
+    for name in names:
+        table, key = CHILD_TABLES[name]
+        index = indexes[name]
+        # Grouped by the parent's own key values, so callers look up children
+        # with the raw value they read
+        keys = {row[key] for row in parent_rows if index.key(row[key]) in index}
+        matched = {index.key(key_value) for key_value in keys}
+        rowids = [rowid for key_value in matched for rowid in index[key_value]]
+        rows = {}
+        if rowids:
+            query = f"SELECT rowid AS source_rowid, * FROM {table} WHERE rowid IN (SELECT value FROM json_each(?))"
+            rows = {row['source_rowid']: row for row in conn.execute(query, (json.dumps(rowids),))}
+        chunk_children[name] = {key_value: [rows[rowid] for rowid in index[index.key(key_value)]] for key_value in keys}
+    return chunk_children
+
+# Lookup tables are small, so each one is loaded into a dict once. A lookup
+# table that is missing from the source is stored as None.
+LOOKUP_TABLES = {
+    'countries': ('tblLand', 'Land_ID', 'Name_Land'),
+    'continents': ('tblKontinent', 'Kontinent_ID', 'Kontnent_Name'),
+    'housing_types': ('lstWohnungsart', 'Wohnart_ID', 'Wohnungsart'),
+    'finance_types': ('lstFinanzierungsart', 'Finanzierungsart_ID', 'FinanzierungsArt'),
+}
+
+def load_lookup(conn, table, key_column, value_column):
+    try:
+        rows = conn.execute(f"SELECT {key_column}, {value_column} FROM {table}").fetchall()
+    except sqlite3.OperationalError:
+        return None
+    lookup = ColumnIndex(column_affinity(conn, table, key_column))
+    for code, name in rows:
+        # Keep the first match, like the old fetchone() lookups did
+        if code is not None:
+            lookup.setdefault(code, name)
+    return lookup
+
+def load_lookups(conn):
+    return {name: load_lookup(conn, *columns) for name, columns in LOOKUP_TABLES.items()}
+
+def resolve_code(lookup, code, default=None):
+    # Unknown codes fall back to default, a missing lookup table resolves to None
+    if lookup is None:
+        return None
+    return lookup.get(lookup.key(code), default)
+
+DEFAULT_BATCH_SIZE = 5000
+
+class BatchWriter:
+    # Buffers inserts per statement and writes them with executemany. Primary
+    # keys of parent tables are assigned here instead of read from lastrowid,
+    # so child rows can be buffered before their parent has been written.
+    def __init__(self, conn, batch_size=DEFAULT_BATCH_SIZE, metrics=None):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.metrics = metrics or Metrics()
+        self.buffers = {}
+        self.pending = 0
+        self.next_ids = {}
+
+    def next_id(self, table):
+        if table not in self.next_ids:
+            # sqlite_sequence keeps ids of deleted rows from being handed out again
+            self.next_ids[table] = self.conn.execute(f"""SELECT MAX(COALESCE((SELECT MAX(id) FROM {table}), 0),
+                                                                 COALESCE((SELECT seq FROM sqlite_sequence WHERE name = '{table}'), 0))""").fetchone()[0] + 1
+        new_id = self.next_ids[table]
+        self.next_ids[table] += 1
+        return new_id
+
+    def insert(self, sql, values):
+        self.buffers.setdefault(sql, []).append(values)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # All buffers are written together and in the order they were first
+        # used, so AUTOINCREMENT ids come out the same as with single inserts
+        with self.metrics.step('write'):
+            for sql, rows in self.buffers.items():
+                if rows:
+                    self.conn.executemany(sql, rows)
+                    rows.clear()
+        self.pending = 0
+
+# Pragmas for --bulk-load: keep the rollback journal in memory, skip fsyncs
+# and use a 256 MiB page cache while loading
+BULK_LOAD_PRAGMAS = {'journal_mode': 'MEMORY', 'synchronous': 'OFF', 'cache_size': -262144}
+SAFE_PRAGMAS = {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'cache_size': -2000}
+
+def set_pragmas(conn, pragmas):
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+
+def sync_file(path, flags=os.O_RDWR):
+    # fsync() needs a writable handle on Windows, where it calls _commit()
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_directory(path):
+    # Makes a rename in the directory durable; directories can't be opened on Windows
+    if os.name == 'posix':
+        sync_file(path, os.O_RDONLY)
+
+DEFAULT_CHECKPOINT_SECONDS = 10
+
+class Progress:
+    # Checkpoints of a build in its .partial file. Each checkpoint commits,
+    # so a restarted build skips completed stages and continues the row
+    # loops after the last source rowid they recorded.
+    def __init__(self, conn, interval=DEFAULT_CHECKPOINT_SECONDS):
+        self.conn = conn
+        self.interval = interval
+        self.last_checkpoint = time.monotonic()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS migration_progress (
+                stage TEXT PRIMARY KEY,
+                last_rowid INTEGER,
+                completed INTEGER NOT NULL DEFAULT 0,
+                details TEXT,
+                updated_at TEXT NOT NULL
+            )
+        ''')
+
+    def get(self, stage):
+        return self.conn.execute("SELECT last_rowid, completed, details FROM migration_progress WHERE stage = ?", (stage,)).fetchone()
+
+    def completed(self, stage):
+        row = self.get(stage)
+        return bool(row and row['completed'])
+
+    def last_rowid(self, stage):
+        row = self.get(stage)
+        return row['last_rowid'] if row else None
+
+    def due(self):
+        return time.monotonic() - self.last_checkpoint >= self.interval
+
+    def checkpoint(self, stage, last_rowid=None, completed=False, details=None):
+        self.conn.execute("INSERT OR REPLACE INTO migration_progress (stage, last_rowid, completed, details, updated_at) VALUES (?, ?, ?, ?, ?)",
+                          (stage, last_rowid, completed, details, datetime.now().isoformat(timespec='seconds')))
+        self.conn.commit()
+        self.last_checkpoint = time.monotonic()
+
+def remove_build(build_path):
+    for path in (build_path, f'{build_path}-journal'):
+        if os.path.exists(path):
+            os.remove(path)
+
+def open_build(build_path, dest_path, options, restart=False, incremental=False, checkpoint_seconds=DEFAULT_CHECKPOINT_SECONDS):
+    # Returns a connection to the .partial build and its Progress. A build
+    # left by an interrupted run is resumed if it was started with the same
+    # options and source file and passes a quick check.
+    if os.path.exists(build_path) and not restart:
+        conn = get_db_connection(build_path)
+        try:
+            row = conn.execute("SELECT details FROM migration_progress WHERE stage = 'options'").fetchone()
+            intact = conn.execute("PRAGMA quick_check").fetchone()[0] == 'ok'
+        except sqlite3.DatabaseError:
+            row, intact = None, False
+        if row and intact and json.loads(row['details']) == options:
+            logging.info("Resuming the build in %s", build_path)
+            print(f"Resuming the interrupted migration in {build_path}")
+            return conn, Progress(conn, checkpoint_seconds)
+        conn.close()
+        logging.info("Discarding %s, it was started with other options or source, or is damaged", build_path)
+
+    remove_build(build_path)
+    conn = get_db_connection(build_path)
+    if incremental and os.path.exists(dest_path):
+        # The delta is applied to a copy, so the current database stays untouched until the rename
+        current = sqlite3.connect(dest_path)
+        try:
+            current.backup(conn)
+        finally:
+            current.close()
+    progress = Progress(conn, checkpoint_seconds)
+    progress.checkpoint('options', completed=True, details=json.dumps(options))
+    return conn, progress
+
+def finish_build(conn, build_path, dest_path):
+    # Drops the checkpoints and atomically replaces dest_path with the build
+    conn.execute("DROP TABLE migration_progress")
+    conn.commit()
+    conn.close()
+    sync_file(build_path)
+    os.replace(build_path, dest_path)
+    sync_directory(os.path.dirname(os.path.abspath(dest_path)))
+
+INSERT_UNIVERSITY = "INSERT OR IGNORE INTO universities (id, name, city, country, continent, website, department, department_website) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+INSERT_ORGANISATION = "INSERT OR IGNORE INTO organisations (id, name, city, country, continent) VALUES (?, ?, ?, ?, ?)"
+
+def university_values(row, uni_id):
+    return (uni_id, row['Uni_Name'], row['Ort'], row['Land'], row['Kontinent'], row['Homepage_Uni'], row['Abteilung'], row['Homepage_Abteilung'])
+
+def organisation_location(row, lookups, fallbacks=None):
+    # Convert country and continent codes to names; codes without a match are kept as they are
+    fallbacks = Counter() if fallbacks is None else fallbacks
+    country_code = row['Land'] if row['Land'] != '' else 'undefined'
+    country_name = resolve_counted(fallbacks, lookups, 'countries', country_code, country_code)
+    continent_name = resolve_counted(fallbacks, lookups, 'continents', row['Kontinent'], row['Kontinent'])
+    return country_name, continent_name
+
+def resolve_counted(fallbacks, lookups, name, code, default=None):
+    # resolve_code() that counts codes without a match in fallbacks
+    lookup = lookups[name]
+    if code is not None and (lookup is None or lookup.key(code) not in lookup):
+        fallbacks[f'unresolved_{name}'] += 1
+    return resolve_code(lookup, code, default)
+
+def rating_counted(fallbacks, rating):
+    # invert_rating() that counts empty and unusable ratings in fallbacks
+    inverted = invert_rating(rating)
+    if inverted is None:
+        fallbacks['empty_rating' if rating is None or rating == '' else 'invalid_rating'] += 1
+    return inverted
+
+# The transform_* functions turn one chunk of source rows into plain tuples
+# that are ready to insert except for the ids the loader assigns. They only
+# read the source, so --workers can run them in other processes.
+def transform_users(rows, children, lookups, fallbacks):
+    return [(row['Student_ID'], row['Stud_Vorname'], row['Stud_Name'], row['email'], row['Telefon'], row['Jahrgang']) for row in rows]
+
+def transform_study(rows, children, lookups, fallbacks):
+    records = []
+    for row in rows:
+        student_id = row['Student_ID']
+        inserts = []
 
         # Migrate finances for study
-        finance_cursor = source_conn.cursor()
-        finance_cursor.execute("SELECT * FROM tblFinanzierung WHERE Student_ID = ?", (row['Student_ID'],))
-        for fin_row in finance_cursor.fetchall():
-            dest_cursor.execute("INSERT INTO finances (study_experience_id, method, amount, finance_institution, finance_institution_city, finance_institution_email,  comments) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                                (study_exp_id, fin_row['Finanzierung_Institution'], fin_row['Betrag'], fin_row['Fin_Amt'], fin_row['FinOrt'], fin_row['finEmail'], fin_row['Hinweise']))
+        for fin_row in children['study_finances'].get(student_id, []):
+            inserts.append(("INSERT INTO finances (study_experience_id, method, amount, finance_institution, finance_institution_city, finance_institution_email,  comments) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (fin_row['Finanzierung_Institution'], fin_row['Betrag'], fin_row['Fin_Amt'], fin_row['FinOrt'], fin_row['finEmail'], fin_row['Hinweise'])))
 
         # Migrate entry_regulations for study
-        entr_regul_cursor = source_conn.cursor()
-        entr_regul_cursor.execute("SELECT * FROM tblEinreise WHERE Student_ID = ?", (row['Student_ID'],))
-        for entr_regul_row in entr_regul_cursor.fetchall():
-            dest_cursor.execute("INSERT INTO entry_regulations (study_experience_id, visa_needed, entry_costs,  application_time, embassy_name, embassy_location, embassy_website, embassy_email, embassy_phone, comments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                                (study_exp_id, str_to_boolean(entr_regul_row['Visum']), entr_regul_row['Kosten'], entr_regul_row['Beantragung_Zeit'], entr_regul_row['Botschaft_Name'], entr_regul_row['BotOrt'], entr_regul_row['Botschaft_Homepage'], entr_regul_row['BotEmail'], entr_regul_row['BotTelefon'], entr_regul_row['Bemerkungen']))
+        for entr_regul_row in children['study_entry_regulations'].get(student_id, []):
+            inserts.append(("INSERT INTO entry_regulations (study_experience_id, visa_needed, entry_costs,  application_time, embassy_name, embassy_location, embassy_website, embassy_email, embassy_phone, comments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (str_to_boolean(entr_regul_row['Visum']), entr_regul_row['Kosten'], entr_regul_row['Beantragung_Zeit'], entr_regul_row['Botschaft_Name'], entr_regul_row['BotOrt'], entr_regul_row['Botschaft_Homepage'], entr_regul_row['BotEmail'], entr_regul_row['BotTelefon'], entr_regul_row['Bemerkungen'])))
 
         # Migrate housing for study
-        housing_cursor = source_conn.cursor()
-        housing_cursor.execute("SELECT w.*, l.Wohnungsart as type_str FROM tblWohnung w LEFT JOIN lstWohnungsart l ON w.WohnungsArt = l.Wohnart_ID WHERE w.Student_ID = ?", (row['Student_ID'],))
-        for housing_row in housing_cursor.fetchall():
-            dest_cursor.execute("INSERT INTO housings (study_experience_id, type, quality, housing_costs, housing_website, housing_email, housing_phone, comments) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                                (study_exp_id, housing_row['type_str'], housing_row['Wohnqualität'], housing_row['WohnKosten'], housing_row['WohnheimHomepage'], housing_row['WohnheimEmail'], housing_row['WohnheimTel'], housing_row['WohnHinweise']))
+        for housing_row in children['study_housings'].get(student_id, []):
+            inserts.append(("INSERT INTO housings (study_experience_id, type, quality, housing_costs, housing_website, housing_email, housing_phone, comments) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (resolve_counted(fallbacks, lookups, 'housing_types', housing_row['WohnungsArt']), housing_row['Wohnqualität'], housing_row['WohnKosten'], housing_row['WohnheimHomepage'], housing_row['WohnheimEmail'], housing_row['WohnheimTel'], housing_row['WohnHinweise'])))
 
         # Migrate vaccinations for study
-        vaccination_cursor = source_conn.cursor()
-        vaccination_cursor.execute("SELECT * FROM tblImpfung WHERE Student_ID = ?", (row['Student_ID'],))
-        for vacc_row in vaccination_cursor.fetchall():
-            dest_cursor.execute("""INSERT INTO vaccinations (
-                                study_experience_id, 
-                                vaccination_type, 
-                                vaccination_costs, 
-                                vaccination_institution,
-                                vaccination_institution_street, 
-                                vaccination_institution_postcode, 
-                                vaccination_institution_city, 
-                                vaccination_institution_phone, 
-                                vaccination_institution_email, 
-                                comments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                                (study_exp_id, 
-                                 vacc_row['Impfungsart'], 
-                                 vacc_row['ImpfKosten'], 
-                                 vacc_row['ImpfEinrichtung'], 
-                                 vacc_row['ImpfStrasse'], 
-                                 vacc_row['ImpfPLZ'], 
-                                 vacc_row['ImpfOrt'], 
-                                 vacc_row['ImpfTelefon'], 
-                                 vacc_row['ImpfEmail'], 
-                                 vacc_row['ImpfHinweise']))
+        for vacc_row in children['study_vaccinations'].get(student_id, []):
+            inserts.append(("""INSERT INTO vaccinations (
+                              study_experience_id, 
+                              vaccination_type, 
+                              vaccination_costs, 
+                              vaccination_institution,
+                              vaccination_institution_street, 
+                              vaccination_institution_postcode, 
+                              vaccination_institution_city, 
+                              vaccination_institution_phone, 
+                              vaccination_institution_email, 
+                              comments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                            (vacc_row['Impfungsart'], 
+                             vacc_row['ImpfKosten'], 
+                             vacc_row['ImpfEinrichtung'], 
+                             vacc_row['ImpfStrasse'], 
+                             vacc_row['ImpfPLZ'], 
+                             vacc_row['ImpfOrt'], 
+                             vacc_row['ImpfTelefon'], 
+                             vacc_row['ImpfEmail'], 
+                             vacc_row['ImpfHinweise'])))
 
         # Migrate courses
-        course_cursor = source_conn.cursor()
-        course_cursor.execute("SELECT * FROM tblKurse WHERE Uni_ID = ?", (row['Uni_ID'],))
-        for course_row in course_cursor.fetchall():
-            dest_cursor.execute("INSERT INTO courses (study_experience_id, title, responsible_person, email,  exam_type, difficulty, comments, practical_training ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                                (study_exp_id, course_row['Kurs_Name'], course_row['Kursverantwortlicher'], course_row['Kursemail'], course_row['Prüfungsform'], course_row['Schwierigkeitsgrad'], course_row['KursHinweise'], str_to_boolean(course_row['Praktika'])))
+        courses = [(course_row['Kurs_Name'], course_row['Kursverantwortlicher'], course_row['Kursemail'], course_row['Prüfungsform'], course_row['Schwierigkeitsgrad'], course_row['KursHinweise'], str_to_boolean(course_row['Praktika']))
+                   for course_row in children['courses'].get(row['Uni_ID'], [])]
 
-    # Migrate internship experiences
-    internship_cursor = source_conn.cursor()
-    internship_cursor.execute("SELECT * FROM tblPraktikumsort")
-    for row in internship_cursor.fetchall():
+        records.append({
+            'university': university_values(row, int(row['Uni_ID'])),
+            'uni_key': row['Uni_ID'],
+            'experience': (student_id, row['Zeitraum Aufenthalt'], row['Studiengebühren'] == 'True', row['Höhe pro Semester']),
+            'children': inserts,
+            'courses': courses,
+        })
+    return records
+
+def transform_internships(rows, children, lookups, fallbacks):
+    records = []
+    for row in rows:
         student_id = row['Student_ID']
         #print(Praktikums_ID)
         praktikums_id = row['Praktikums_ID']
 
-        country_name = row['Land'] if row['Land'] != '' else 'undefined'
-        try:
-            # Attempt to convert country code to name using tblLand
-            country_name_row = source_cursor.execute("SELECT Name_Land FROM tblLand WHERE Land_ID = ?", (country_name,)).fetchone()
-            if country_name_row:
-                # print(country_name_row["Name_Land"])
-                country_name = country_name_row['Name_Land']
-        except sqlite3.OperationalError:
-            # If tblLand doesn't exist or there's an error, assume 'Land' already contains the name
-            country_name = None
-
-        continent_name = row['Kontinent']
-        try: 
-            # Attempt to convert continent code to name using tblKontinent
-            continent_name_row = source_cursor.execute("SELECT Kontnent_Name FROM tblKontinent WHERE Kontinent_ID = ?", (continent_name,)).fetchone()
-            if continent_name_row:
-                continent_name = continent_name_row['Kontnent_Name']
-        except sqlite3.OperationalError:
-            # If tblKontinent doesn't exist or there's an error, assume 'Kontinent' already contains the name
-            continent_name = None
-        
-
-        dest_cursor.execute("INSERT OR IGNORE INTO organisations (id, name, city, country, continent) VALUES (?, ?, ?, ?, ?)",
-                            (praktikums_id, row['NameOrganisation'], row['OrtPraktikum'], country_name, continent_name))
-        work_desc_cursor = source_conn.cursor()
-        work_desc_row = work_desc_cursor.execute("SELECT * FROM tblPraktikumsarbeit WHERE Praktikums_ID = ?", (praktikums_id,)).fetchone()
-        
-        dest_cursor.execute("INSERT INTO internship_experiences ( user_id, organisation_id, duration, work_description, topic, other_tasks, supervisor_rating, organization_rating, comments, internship_contact_person, internship_contact_email, internship_website) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                            (student_id, praktikums_id, row['Zeitraum'], 
-                             work_desc_row['BeschreibungTätigkeit'] if work_desc_row else None,
-                             work_desc_row['ThemaPraktikum'] if work_desc_row else 'NULL',
-                             work_desc_row['SonstigeArbeiten'] if work_desc_row else None,
-                             invert_rating(work_desc_row['BewertungBetreuung']) if work_desc_row else None,
-                             invert_rating(work_desc_row['BewertungOrganisation']) if work_desc_row else None,
-                             work_desc_row['KommentarPraktikum'] if work_desc_row else None,
-                             row['KonatktpersonPraktikum'],
-                             row['EmailPraktikum'],
-                             row['HomepagePraktikum']))
-        internship_exp_id = dest_cursor.lastrowid
+        country_name, continent_name = organisation_location(row, lookups, fallbacks)
+        work_desc_rows = children['work_descriptions'].get(praktikums_id)
+        work_desc_row = work_desc_rows[0] if work_desc_rows else None
+        if work_desc_row is None:
+            fallbacks['missing_work_description'] += 1
+        inserts = []
 
         # Migrate finances for internship
-        finance_cursor = source_conn.cursor()
-        finance_cursor.execute("SELECT f.*, l.FinanzierungsArt as method_str FROM tblPraktFinanzen f LEFT JOIN lstFinanzierungsart l ON f.PraktFinanzier = l.Finanzierungsart_ID WHERE f.Student_ID = ?", (student_id,))
-        for fin_row in finance_cursor.fetchall():
-            dest_cursor.execute("INSERT INTO finances (internship_experience_id, method, amount, comments, is_salary, finance_institution_website, finance_institution_email) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                                (internship_exp_id, fin_row['method_str'], fin_row['Höhe'], fin_row['Hinweise'], str_to_boolean(fin_row['Praktikumsgehalt']), fin_row['Prakt_Homepage'], fin_row['Prakt_email']))
+        for fin_row in children['internship_finances'].get(student_id, []):
+            inserts.append(("INSERT INTO finances (internship_experience_id, method, amount, comments, is_salary, finance_institution_website, finance_institution_email) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (resolve_counted(fallbacks, lookups, 'finance_types', fin_row['PraktFinanzier']), fin_row['Höhe'], fin_row['Hinweise'], str_to_boolean(fin_row['Praktikumsgehalt']), fin_row['Prakt_Homepage'], fin_row['Prakt_email'])))
 
         # Migrate entry_regulations for internship
-        entr_regul_cursor = source_conn.cursor()
-        entr_regul_cursor.execute("SELECT * FROM tblPraktikumVisum WHERE Student_ID = ?", (student_id,))
-        for entr_regul_row in entr_regul_cursor.fetchall():
-            dest_cursor.execute("INSERT INTO entry_regulations (internship_experience_id, visa_needed, entry_costs, embassy_name, embassy_location, application_time, comments, embassy_website, embassy_email, embassy_phone) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                                (internship_exp_id, str_to_boolean(entr_regul_row['P_Visum']) , entr_regul_row['P_Visumskosten'], entr_regul_row['P_Botschaft'], entr_regul_row['P_BotOrt'], entr_regul_row['P_Beantragung_Zeit'], entr_regul_row['Bemerkungen'], entr_regul_row['P_Bot_Homepage'], entr_regul_row['P_BotEmail'], entr_regul_row['P_BotTelefon']))
+        for entr_regul_row in children['internship_entry_regulations'].get(student_id, []):
+            inserts.append(("INSERT INTO entry_regulations (internship_experience_id, visa_needed, entry_costs, embassy_name, embassy_location, application_time, comments, embassy_website, embassy_email, embassy_phone) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (str_to_boolean(entr_regul_row['P_Visum']) , entr_regul_row['P_Visumskosten'], entr_regul_row['P_Botschaft'], entr_regul_row['P_BotOrt'], entr_regul_row['P_Beantragung_Zeit'], entr_regul_row['Bemerkungen'], entr_regul_row['P_Bot_Homepage'], entr_regul_row['P_BotEmail'], entr_regul_row['P_BotTelefon'])))
 
         # Migrate housing for internship
-        housing_cursor = source_conn.cursor()
-        housing_cursor.execute("SELECT w.*, l.Wohnungsart as type_str FROM tblPraktikumWohnung w LEFT JOIN lstWohnungsart l ON w.WohnungsArt = l.Wohnart_ID WHERE w.Student_ID = ?", (student_id,))
-        for housing_row in housing_cursor.fetchall():
-            dest_cursor.execute("INSERT INTO housings (internship_experience_id, type, quality, housing_costs, housing_website, housing_email, housing_phone, comments) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                                (internship_exp_id, housing_row['type_str'], housing_row['Wohnqualität'], housing_row['WohnKosten'], housing_row['WohnheimHomepage'], housing_row['WohnheimEmail'], housing_row['WohnheimTel'], housing_row['WohnHinweise']))
+        for housing_row in children['internship_housings'].get(student_id, []):
+            inserts.append(("INSERT INTO housings (internship_experience_id, type, quality, housing_costs, housing_website, housing_email, housing_phone, comments) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (resolve_counted(fallbacks, lookups, 'housing_types', housing_row['WohnungsArt']), housing_row['Wohnqualität'], housing_row['WohnKosten'], housing_row['WohnheimHomepage'], housing_row['WohnheimEmail'], housing_row['WohnheimTel'], housing_row['WohnHinweise'])))
 
         # Migrate vaccinations for internship
-        vaccination_cursor = source_conn.cursor()
-        vaccination_cursor.execute("SELECT * FROM tblPraktikumImpfung WHERE Student_ID = ?", (student_id,))
-        for vacc_row in vaccination_cursor.fetchall():
-            dest_cursor.execute("""INSERT INTO vaccinations (
-                                internship_experience_id, 
-                                vaccination_type, 
-                                vaccination_costs, 
-                                vaccination_institution,
-                                vaccination_institution_street, 
-                                vaccination_institution_postcode, 
-                                vaccination_institution_city, 
-                                vaccination_institution_phone, 
-                                vaccination_institution_email, 
-                                comments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                                (internship_exp_id, 
-                                 vacc_row['PraktImpfungsart'], 
-                                 vacc_row['PraktImpfKosten'], 
-                                 vacc_row['PraktImpfEinrichtung'], 
-                                 vacc_row['PraktImpfStrasse'], 
-                                 vacc_row['PraktImpfPLZ'], 
-                                 vacc_row['PraktImpfOrt'], 
-                                 vacc_row['PraktImpfTelefon'], 
-                                 vacc_row['PraktImpfEmail'], 
-                                 vacc_row['PraktImpfHinweise']))
+        for vacc_row in children['internship_vaccinations'].get(student_id, []):
+            inserts.append(("""INSERT INTO vaccinations (
+                              internship_experience_id, 
+                              vaccination_type, 
+                              vaccination_costs, 
+                              vaccination_institution,
+                              vaccination_institution_street, 
+                              vaccination_institution_postcode, 
+                              vaccination_institution_city, 
+                              vaccination_institution_phone, 
+                              vaccination_institution_email, 
+                              comments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                            (vacc_row['PraktImpfungsart'], 
+                             vacc_row['PraktImpfKosten'], 
+                             vacc_row['PraktImpfEinrichtung'], 
+                             vacc_row['PraktImpfStrasse'], 
+                             vacc_row['PraktImpfPLZ'], 
+                             vacc_row['PraktImpfOrt'], 
+                             vacc_row['PraktImpfTelefon'], 
+                             vacc_row['PraktImpfEmail'], 
+                             vacc_row['PraktImpfHinweise'])))
+
+        records.append({
+            'organisation': (praktikums_id, row['NameOrganisation'], row['OrtPraktikum'], country_name, continent_name),
+            'experience': (student_id, row['Zeitraum'],
+                           work_desc_row['BeschreibungTätigkeit'] if work_desc_row else None,
+                           work_desc_row['ThemaPraktikum'] if work_desc_row else 'NULL',
+                           work_desc_row['SonstigeArbeiten'] if work_desc_row else None,
+                           rating_counted(fallbacks, work_desc_row['BewertungBetreuung']) if work_desc_row else None,
+                           rating_counted(fallbacks, work_desc_row['BewertungOrganisation']) if work_desc_row else None,
+                           work_desc_row['KommentarPraktikum'] if work_desc_row else None,
+                           row['KonatktpersonPraktikum'],
+                           row['EmailPraktikum'],
+                           row['HomepagePraktikum']),
+            'children': inserts,
+        })
+    return records
+
+class Loader:
+    # Writes transformed records through a BatchWriter. Ids and the --dedupe
+    # merging depend on the order of all rows before, so they are only
+    # assigned here, in source order.
+    def __init__(self, writer, dedupe=False):
+        self.writer = writer
+        self.dedupe = dedupe
+        # Hash indexes from entity_key() to the id of the first university or
+        # organisation with that key, and the Uni_IDs whose courses are linked
+        self.universities = {}
+        self.organisations = {}
+        self.linked_courses = set()
+
+    def restore(self, source_conn, table, last_rowid, lookups):
+        # Rebuilds the --dedupe state of the rows up to last_rowid, which a
+        # resumed build loaded before its last checkpoint
+        if not self.dedupe:
+            return
+        if table == 'tblUniversität':
+            for row in source_conn.execute("SELECT Uni_ID, Uni_Name, Ort, Land FROM tblUniversität WHERE rowid <= ? ORDER BY rowid", (last_rowid,)):
+                self.universities.setdefault(entity_key(row['Uni_Name'], row['Ort'], row['Land']), int(row['Uni_ID']))
+                self.linked_courses.add(row['Uni_ID'])
+        elif table == 'tblPraktikumsort':
+            for row in source_conn.execute("SELECT Praktikums_ID, NameOrganisation, OrtPraktikum, Land, Kontinent FROM tblPraktikumsort WHERE rowid <= ? ORDER BY rowid", (last_rowid,)):
+                country_name, _ = organisation_location(row, lookups)
+                self.organisations.setdefault(entity_key(row['NameOrganisation'], row['OrtPraktikum'], country_name), row['Praktikums_ID'])
+
+    def load_users(self, records):
+        for values in records:
+            self.writer.insert("INSERT INTO users (id, first_name, last_name, user_email, user_phone, class_year) VALUES (?, ?, ?, ?, ?, ?)", values)
+
+    def load_study(self, records):
+        writer = self.writer
+        for record in records:
+            university = record['university']
+            uni_id = university[0]
+            if self.dedupe:
+                uni_id = self.universities.setdefault(entity_key(*university[1:4]), uni_id)
+            writer.insert(INSERT_UNIVERSITY, (uni_id,) + university[1:])
+
+            student_id, *experience = record['experience']
+            study_exp_id = writer.next_id('study_experiences')
+            writer.insert("INSERT INTO study_experiences (id, user_id, university_id, duration, study_fees, tuition_cost) VALUES (?, ?, ?, ?, ?, ?)",
+                          (study_exp_id, student_id, uni_id, *experience))
+            for sql, values in record['children']:
+                writer.insert(sql, (study_exp_id,) + values)
+
+            if self.dedupe:
+                if record['uni_key'] in self.linked_courses:
+                    continue
+                self.linked_courses.add(record['uni_key'])
+            for values in record['courses']:
+                writer.insert("INSERT INTO courses (study_experience_id, university_id, title, responsible_person, email,  exam_type, difficulty, comments, practical_training ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              (None if self.dedupe else study_exp_id, uni_id) + values)
+
+    def load_internships(self, records):
+        writer = self.writer
+        for record in records:
+            organisation = record['organisation']
+            organisation_id = organisation[0]
+            if self.dedupe:
+                organisation_id = self.organisations.setdefault(entity_key(*organisation[1:4]), organisation_id)
+            writer.insert(INSERT_ORGANISATION, (organisation_id,) + organisation[1:])
+
+            student_id, *experience = record['experience']
+            internship_exp_id = writer.next_id('internship_experiences')
+            writer.insert("INSERT INTO internship_experiences (id, user_id, organisation_id, duration, work_description, topic, other_tasks, supervisor_rating, organization_rating, comments, internship_contact_person, internship_contact_email, internship_website) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (internship_exp_id, student_id, organisation_id, *experience))
+            for sql, values in record['children']:
+                writer.insert(sql, (internship_exp_id,) + values)
+
+# Source table, child tables, transform function and Loader method of each
+# phase, in the order they are migrated
+PHASES = [
+    ('tblStudenten', [], transform_users, 'load_users'),
+    ('tblUniversität', STUDY_CHILDREN, transform_study, 'load_study'),
+    ('tblPraktikumsort', INTERNSHIP_CHILDREN, transform_internships, 'load_internships'),
+]
+
+def migrate_python(source_conn, dest_conn, batch_size=DEFAULT_BATCH_SIZE, chunk_size=DEFAULT_CHUNK_SIZE, dedupe=False, student_ids=None,
+                   metrics=None, progress=None):
+    # With progress, each phase checkpoints the last source rowid it loaded
+    # and a resumed build continues after it
+    metrics = metrics or Metrics()
+    loader = Loader(BatchWriter(dest_conn, batch_size, metrics), dedupe)
+    with metrics.step('preload'):
+        indexes = preload_children(source_conn, chunk_size)
+        lookups = load_lookups(source_conn)
+
+    # Incremental runs only migrate the given students
+    conditions, params = [], []
+    if student_ids is not None:
+        # Selects exactly the students delete_students() removed
+        source_conn.create_function('numeric_value', 1, numeric_value, deterministic=True)
+        conditions.append("numeric_value(Student_ID) IN (SELECT value FROM json_each(?))")
+        params.append(json_param(student_ids))
+
+    for table, child_names, transform, load in PHASES:
+        stage = f'migrate:{table}'
+        if progress and progress.completed(stage):
+            continue
+        phase_conditions, phase_params = list(conditions), list(params)
+        last_rowid = progress.last_rowid(stage) if progress else None
+        if last_rowid is not None:
+            loader.restore(source_conn, table, last_rowid, lookups)
+            phase_conditions.append("rowid > ?")
+            phase_params.append(last_rowid)
+        where = f"WHERE {' AND '.join(phase_conditions)}" if phase_conditions else ''
+
+        chunks = iter_chunks(source_conn, f"SELECT rowid AS source_rowid, * FROM {table} {where}", chunk_size, phase_params)
+        while True:
+            with metrics.step('read'):
+                rows = next(chunks, None)
+                if rows is None:
+                    break
+                children = load_chunk_children(source_conn, indexes, child_names, rows)
+            metrics.read_chunk(table, rows, child_names, children)
+            with metrics.step('transform'):
+                records = transform(rows, children, lookups, metrics.fallbacks)
+            # Includes the 'write' step whenever the batch fills up
+            with metrics.step('load'):
+                getattr(loader, load)(records)
+            if progress and progress.due():
+                loader.writer.flush()
+                progress.checkpoint(stage, rows[-1]['source_rowid'])
+        if progress:
+            loader.writer.flush()
+            progress.checkpoint(stage, completed=True)
+
+    loader.writer.flush()
+
+def get_read_only_connection(db_name):
+    conn = sqlite3.connect(f"{Path(db_name).resolve().as_uri()}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+# State of a --workers process: its read-only source connection, the child
+# indexes and the lookups
+worker_state = {}
+
+def init_worker(source_path, chunk_size):
+    conn = get_read_only_connection(source_path)
+    worker_state.update(conn=conn, indexes=preload_children(conn, chunk_size), lookups=load_lookups(conn))
+
+def transform_range(phase, first_rowid, last_rowid):
+    # Returns the records of one rowid range with the rows read and the
+    # fallbacks counted for it
+    table, child_names, transform, _ = PHASES[phase]
+    conn = worker_state['conn']
+    rows = conn.execute(f"SELECT * FROM {table} WHERE rowid BETWEEN ? AND ?", (first_rowid, last_rowid)).fetchall()
+    children = load_chunk_children(conn, worker_state['indexes'], child_names, rows)
+    metrics = Metrics()
+    metrics.read_chunk(table, rows, child_names, children)
+    return transform(rows, children, worker_state['lookups'], metrics.fallbacks), metrics.rows_read, metrics.fallbacks
+
+def rowid_ranges(conn, table, chunk_size, after=None):
+    first, last = conn.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {table}").fetchone()
+    if first is None:
+        return []
+    if after is not None:
+        first = max(first, after + 1)
+    return [(start, min(start + chunk_size - 1, last)) for start in range(first, last + 1, chunk_size)]
+
+def migrate_parallel(source_conn, dest_conn, source_path, workers, batch_size=DEFAULT_BATCH_SIZE, chunk_size=DEFAULT_CHUNK_SIZE, dedupe=False,
+                     metrics=None, progress=None):
+    # Workers transform rowid ranges of the source tables on their own
+    # read-only connections; this process is the only writer. At most two
+    # ranges per worker are in flight, and results are loaded in range order
+    # so ids come out the same as with migrate_python().
+    metrics = metrics or Metrics()
+    loader = Loader(BatchWriter(dest_conn, batch_size, metrics), dedupe)
+
+    def load_next():
+        (phase, _, last), result = pending.popleft()
+        with metrics.step('wait'):
+            records, rows_read, fallbacks = result.get()
+        metrics.merge(rows_read, fallbacks)
+        with metrics.step('load'):
+            getattr(loader, PHASES[phase][3])(records)
+        if progress and progress.due():
+            loader.writer.flush()
+            progress.checkpoint(f'migrate:{PHASES[phase][0]}', last)
+
+    tasks = []
+    lookups = load_lookups(source_conn)
+    for phase, (table, _, _, _) in enumerate(PHASES):
+        stage = f'migrate:{table}'
+        if progress and progress.completed(stage):
+            continue
+        last_rowid = progress.last_rowid(stage) if progress else None
+        if last_rowid is not None:
+            loader.restore(source_conn, table, last_rowid, lookups)
+        tasks += [(phase, first, last) for first, last in rowid_ranges(source_conn, table, chunk_size, last_rowid)]
+        # Marks the phase as completed once its last range is loaded
+        tasks.append((phase, None, None))
+
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(source_path, chunk_size)) as pool:
+        pending = deque()
+        for task in tasks:
+            if task[1] is None:
+                while pending:
+                    load_next()
+                if progress:
+                    loader.writer.flush()
+                    progress.checkpoint(f'migrate:{PHASES[task[0]][0]}', completed=True)
+                continue
+            pending.append((task, pool.apply_async(transform_range, task)))
+            if len(pending) >= 2 * workers:
+                load_next()
+        while pending:
+            load_next()
+    loader.writer.flush()
+
+def sql_boolean(expression):
+    # str_to_boolean() as a CASE expression
+    return f"CASE lower({expression}) WHEN 'true' THEN 1 WHEN 'false' THEN 0 END"
+
+def sql_lookup(conn, name, alias, code, default='NULL'):
+    # Returns a join clause and the expression resolving code, with the same
+    # semantics as resolve_code(): first match wins, unknown codes give default
+    # and a missing lookup table gives NULL
+    table, key_column, value_column = LOOKUP_TABLES[name]
+    try:
+        conn.execute(f"SELECT {key_column}, {value_column} FROM src.{table} LIMIT 0")
+    except sqlite3.OperationalError:
+        return '', 'NULL'
+    join = (f"LEFT JOIN (SELECT {key_column} AS code, {value_column} AS name FROM src.{table} "
+            f"WHERE rowid IN (SELECT MIN(rowid) FROM src.{table} GROUP BY {key_column})) {alias} ON {alias}.code = +({code})")
+    return join, f"CASE WHEN {alias}.code IS NULL THEN {default} ELSE {alias}.name END"
+
+def migrate_sql(dest_conn, source_path, dedupe=False):
+    # Same mapping as migrate_python(), but every table is copied with one
+    # INSERT ... SELECT on the attached source. Experience ids are numbered in
+    # source order, so child rows get the same ids as with the Python engine.
+    # Parent keys are kept as read and joined as +key, which has no affinity,
+    # so a child column compares them like the old "WHERE key = ?" queries.
+    dest_conn.execute("ATTACH DATABASE ? AS src", (source_path,))
+    dest_conn.create_function('invert_rating', 1, invert_rating, deterministic=True)
+    dest_conn.create_function('entity_key', 3, entity_key, deterministic=True)
+    cursor = dest_conn.cursor()
+
+    # Rows committed by a run that was interrupted before its checkpoint are
+    # cleared in the same transaction, so a resumed run starts over cleanly
+    for table in reversed(TABLES):
+        cursor.execute(f"DELETE FROM {table}")
+    cursor.execute("DELETE FROM sqlite_sequence WHERE name IN (SELECT value FROM json_each(?))", (json.dumps(TABLES),))
+
+    cursor.execute("""INSERT INTO users (id, first_name, last_name, user_email, user_phone, class_year)
+                      SELECT Student_ID, Stud_Vorname, Stud_Name, email, Telefon, Jahrgang FROM src.tblStudenten ORDER BY rowid""")
+
+    # Migrate study experiences
+    study_offset = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM study_experiences").fetchone()[0]
+    university_id = "CAST(Uni_ID AS INTEGER)"
+    if dedupe:
+        university_id = f"FIRST_VALUE({university_id}) OVER (PARTITION BY entity_key(Uni_Name, Ort, Land) ORDER BY rowid)"
+    cursor.execute(f"""CREATE TEMP TABLE study_map AS
+                       SELECT ROW_NUMBER() OVER (ORDER BY rowid) + ? AS id, rowid AS source_rowid, +Student_ID AS Student_ID, +Uni_ID AS Uni_ID, {university_id} AS university_id
+                       FROM src.tblUniversität""", (study_offset,))
+    cursor.execute("""INSERT OR IGNORE INTO universities (id, name, city, country, continent, website, department, department_website)
+                      SELECT m.university_id, u.Uni_Name, u.Ort, u.Land, u.Kontinent, u.Homepage_Uni, u.Abteilung, u.Homepage_Abteilung
+                      FROM temp.study_map m JOIN src.tblUniversität u ON u.rowid = m.source_rowid ORDER BY m.id""")
+    cursor.execute("""INSERT INTO study_experiences (id, user_id, university_id, duration, study_fees, tuition_cost)
+                      SELECT m.id, u.Student_ID, m.university_id, u."Zeitraum Aufenthalt", IFNULL(u.Studiengebühren = 'True', 0), u."Höhe pro Semester"
+                      FROM temp.study_map m JOIN src.tblUniversität u ON u.rowid = m.source_rowid ORDER BY m.id""")
+    cursor.execute("""INSERT INTO finances (study_experience_id, method, amount, finance_institution, finance_institution_city, finance_institution_email, comments)
+                      SELECT m.id, f.Finanzierung_Institution, f.Betrag, f.Fin_Amt, f.FinOrt, f.finEmail, f.Hinweise
+                      FROM temp.study_map m JOIN src.tblFinanzierung f ON f.Student_ID = +m.Student_ID ORDER BY m.id, f.rowid""")
+    cursor.execute(f"""INSERT INTO entry_regulations (study_experience_id, visa_needed, entry_costs, application_time, embassy_name, embassy_location, embassy_website, embassy_email, embassy_phone, comments)
+                       SELECT m.id, {sql_boolean('e.Visum')}, e.Kosten, e.Beantragung_Zeit, e.Botschaft_Name, e.BotOrt, e.Botschaft_Homepage, e.BotEmail, e.BotTelefon, e.Bemerkungen
+                       FROM temp.study_map m JOIN src.tblEinreise e ON e.Student_ID = +m.Student_ID ORDER BY m.id, e.rowid""")
+    type_join, type_name = sql_lookup(dest_conn, 'housing_types', 'ht', 'w.WohnungsArt')
+    cursor.execute(f"""INSERT INTO housings (study_experience_id, type, quality, housing_costs, housing_website, housing_email, housing_phone, comments)
+                       SELECT m.id, {type_name}, w.Wohnqualität, w.WohnKosten, w.WohnheimHomepage, w.WohnheimEmail, w.WohnheimTel, w.WohnHinweise
+                       FROM temp.study_map m JOIN src.tblWohnung w ON w.Student_ID = +m.Student_ID {type_join} ORDER BY m.id, w.rowid""")
+    cursor.execute("""INSERT INTO vaccinations (study_experience_id, vaccination_type, vaccination_costs, vaccination_institution, vaccination_institution_street,
+                                               vaccination_institution_postcode, vaccination_institution_city, vaccination_institution_phone, vaccination_institution_email, comments)
+                      SELECT m.id, i.Impfungsart, i.ImpfKosten, i.ImpfEinrichtung, i.ImpfStrasse, i.ImpfPLZ, i.ImpfOrt, i.ImpfTelefon, i.ImpfEmail, i.ImpfHinweise
+                      FROM temp.study_map m JOIN src.tblImpfung i ON i.Student_ID = +m.Student_ID ORDER BY m.id, i.rowid""")
+    # With dedupe, courses are linked once, at the first visit of each Uni_ID
+    course_visits = "WHERE m.id IN (SELECT MIN(id) FROM temp.study_map GROUP BY Uni_ID)" if dedupe else ""
+    cursor.execute(f"""INSERT INTO courses (study_experience_id, university_id, title, responsible_person, email, exam_type, difficulty, comments, practical_training)
+                       SELECT {'NULL' if dedupe else 'm.id'}, m.university_id, k.Kurs_Name, k.Kursverantwortlicher, k.Kursemail, k.Prüfungsform, k.Schwierigkeitsgrad, k.KursHinweise, {sql_boolean('k.Praktika')}
+                       FROM temp.study_map m JOIN src.tblKurse k ON k.Uni_ID = +m.Uni_ID {course_visits} ORDER BY m.id, k.rowid""")
+
+    # Migrate internship experiences
+    internship_offset = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM internship_experiences").fetchone()[0]
+    country_code = "CASE WHEN p.Land = '' THEN 'undefined' ELSE p.Land END"
+    country_join, country_name = sql_lookup(dest_conn, 'countries', 'country', country_code, country_code)
+    continent_join, continent_name = sql_lookup(dest_conn, 'continents', 'continent', 'p.Kontinent', 'p.Kontinent')
+    cursor.execute(f"""CREATE TEMP TABLE internship_map AS
+                       SELECT ROW_NUMBER() OVER (ORDER BY p.rowid) + ? AS id, p.rowid AS source_rowid, +p.Student_ID AS Student_ID, p.Praktikums_ID AS organisation_id,
+                              {country_name} AS country, {continent_name} AS continent
+                       FROM src.tblPraktikumsort p {country_join} {continent_join}""", (internship_offset,))
+    if dedupe:
+        cursor.execute("""UPDATE temp.internship_map SET organisation_id = canonical.organisation_id
+                          FROM (SELECT m.id, FIRST_VALUE(p.Praktikums_ID) OVER (PARTITION BY entity_key(p.NameOrganisation, p.OrtPraktikum, m.country) ORDER BY m.id) AS organisation_id
+                                FROM temp.internship_map m JOIN src.tblPraktikumsort p ON p.rowid = m.source_rowid) canonical
+                          WHERE canonical.id = internship_map.id""")
+    # Only the first work description of an internship is used
+    cursor.execute("""CREATE TEMP TABLE first_work_descriptions AS
+                      SELECT * FROM src.tblPraktikumsarbeit
+                      WHERE rowid IN (SELECT MIN(rowid) FROM src.tblPraktikumsarbeit GROUP BY Praktikums_ID)""")
+    cursor.execute("CREATE INDEX temp.first_work_descriptions_id ON first_work_descriptions (Praktikums_ID)")
+    cursor.execute("""INSERT OR IGNORE INTO organisations (id, name, city, country, continent)
+                      SELECT m.organisation_id, p.NameOrganisation, p.OrtPraktikum, m.country, m.continent
+                      FROM temp.internship_map m JOIN src.tblPraktikumsort p ON p.rowid = m.source_rowid ORDER BY m.id""")
+    cursor.execute("""INSERT INTO internship_experiences (id, user_id, organisation_id, duration, work_description, topic, other_tasks, supervisor_rating, organization_rating,
+                                                         comments, internship_contact_person, internship_contact_email, internship_website)
+                      SELECT m.id, p.Student_ID, m.organisation_id, p.Zeitraum, w.BeschreibungTätigkeit,
+                             CASE WHEN w.Praktikums_ID IS NULL THEN 'NULL' ELSE w.ThemaPraktikum END,
+                             w.SonstigeArbeiten, invert_rating(w.BewertungBetreuung), invert_rating(w.BewertungOrganisation), w.KommentarPraktikum,
+                             p.KonatktpersonPraktikum, p.EmailPraktikum, p.HomepagePraktikum
+                      FROM temp.internship_map m JOIN src.tblPraktikumsort p ON p.rowid = m.source_rowid
+                      LEFT JOIN temp.first_work_descriptions w ON w.Praktikums_ID = +p.Praktikums_ID ORDER BY m.id""")
+    method_join, method_name = sql_lookup(dest_conn, 'finance_types', 'ft', 'f.PraktFinanzier')
+    cursor.execute(f"""INSERT INTO finances (internship_experience_id, method, amount, comments, is_salary, finance_institution_website, finance_institution_email)
+                       SELECT m.id, {method_name}, f.Höhe, f.Hinweise, {sql_boolean('f.Praktikumsgehalt')}, f.Prakt_Homepage, f.Prakt_email
+                       FROM temp.internship_map m JOIN src.tblPraktFinanzen f ON f.Student_ID = +m.Student_ID {method_join} ORDER BY m.id, f.rowid""")
+    cursor.execute(f"""INSERT INTO entry_regulations (internship_experience_id, visa_needed, entry_costs, embassy_name, embassy_location, application_time, comments, embassy_website, embassy_email, embassy_phone)
+                       SELECT m.id, {sql_boolean('v.P_Visum')}, v.P_Visumskosten, v.P_Botschaft, v.P_BotOrt, v.P_Beantragung_Zeit, v.Bemerkungen, v.P_Bot_Homepage, v.P_BotEmail, v.P_BotTelefon
+                       FROM temp.internship_map m JOIN src.tblPraktikumVisum v ON v.Student_ID = +m.Student_ID ORDER BY m.id, v.rowid""")
+    type_join, type_name = sql_lookup(dest_conn, 'housing_types', 'ht', 'w.WohnungsArt')
+    cursor.execute(f"""INSERT INTO housings (internship_experience_id, type, quality, housing_costs, housing_website, housing_email, housing_phone, comments)
+                       SELECT m.id, {type_name}, w.Wohnqualität, w.WohnKosten, w.WohnheimHomepage, w.WohnheimEmail, w.WohnheimTel, w.WohnHinweise
+                       FROM temp.internship_map m JOIN src.tblPraktikumWohnung w ON w.Student_ID = +m.Student_ID {type_join} ORDER BY m.id, w.rowid""")
+    cursor.execute("""INSERT INTO vaccinations (internship_experience_id, vaccination_type, vaccination_costs, vaccination_institution, vaccination_institution_street,
+                                               vaccination_institution_postcode, vaccination_institution_city, vaccination_institution_phone, vaccination_institution_email, comments)
+                      SELECT m.id, i.PraktImpfungsart, i.PraktImpfKosten, i.PraktImpfEinrichtung, i.PraktImpfStrasse, i.PraktImpfPLZ, i.PraktImpfOrt, i.PraktImpfTelefon, i.PraktImpfEmail, i.PraktImpfHinweise
+                      FROM temp.internship_map m JOIN src.tblPraktikumImpfung i ON i.Student_ID = +m.Student_ID ORDER BY m.id, i.rowid""")
 
+    for table in ('study_map', 'internship_map', 'first_work_descriptions'):
+        cursor.execute(f"DROP TABLE temp.{table}")
     dest_conn.commit()
+    dest_conn.execute("DETACH DATABASE src")
+
+# Built once after the load instead of being updated on every insert. They
+# cover the viewer's per-card child lookups and the joins of its experience
+# queries. The location filters run in JavaScript, so they need no index.
+INDEXES = {
+    'study_experiences_user_id': ('study_experiences', 'user_id'),
+    'study_experiences_university_id': ('study_experiences', 'university_id'),
+    'internship_experiences_user_id': ('internship_experiences', 'user_id'),
+    'internship_experiences_organisation_id': ('internship_experiences', 'organisation_id'),
+    'courses_study_experience_id': ('courses', 'study_experience_id'),
+    'courses_university_id': ('courses', 'university_id'),
+    'finances_study_experience_id': ('finances', 'study_experience_id'),
+    'finances_internship_experience_id': ('finances', 'internship_experience_id'),
+    'entry_regulations_study_experience_id': ('entry_regulations', 'study_experience_id'),
+    'entry_regulations_internship_experience_id': ('entry_regulations', 'internship_experience_id'),
+    'housings_study_experience_id': ('housings', 'study_experience_id'),
+    'housings_internship_experience_id': ('housings', 'internship_experience_id'),
+    'vaccinations_study_experience_id': ('vaccinations', 'study_experience_id'),
+    'vaccinations_internship_experience_id': ('vaccinations', 'internship_experience_id'),
+}
+
+def create_indexes(conn):
+    for name, (table, columns) in INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+    # Store statistics so the query planner (also sql.js in the viewer) picks the indexes up
+    conn.execute("ANALYZE")
+    conn.commit()
+
+def json_rows(conn, table, alias):
+    # json_array() over all columns of a table, in table order, so the viewer
+    # can keep reading child rows by column position
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    return "json_array(" + ", ".join(f"{alias}.{column}" for column in columns) + ")"
+
+# Courses belong to a study experience, or only to its university when they were deduplicated
+STUDY_COURSES = "(c.study_experience_id = e.id OR (c.study_experience_id IS NULL AND c.university_id = e.university_id))"
+
+def child_json(conn, table, id_column):
+    condition = STUDY_COURSES if table == 'courses' else f"c.{id_column} = e.id"
+    return f"(SELECT json_group_array({json_rows(conn, table, 'c')}) FROM {table} c WHERE {condition})"
+
+def create_experience_cards(conn):
+    # One denormalized row per study or internship experience, with the child
+    # rows pre-aggregated as JSON, so the viewer can load everything with a
+    # single scan instead of one query per child table and card
+    conn.execute("DROP TABLE IF EXISTS experience_cards")
+    conn.execute('''
+        CREATE TABLE experience_cards (
+            id INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            experience_id INTEGER NOT NULL,
+            first_name TEXT,
+            last_name TEXT,
+            user_email TEXT,
+            user_phone TEXT,
+            class_year TEXT,
+            university_name TEXT,
+            organisation_name TEXT,
+            city TEXT,
+            country TEXT,
+            continent TEXT,
+            website TEXT,
+            department_website TEXT,
+            duration TEXT,
+            tuition_cost TEXT,
+            topic TEXT,
+            work_description TEXT,
+            other_tasks TEXT,
+            supervisor_rating INTEGER,
+            organization_rating INTEGER,
+            comments TEXT,
+            internship_website TEXT,
+            internship_contact_person TEXT,
+            internship_contact_email TEXT,
+            courses TEXT,
+            finances TEXT,
+            housings TEXT,
+            entry_regulations TEXT,
+            vaccinations TEXT
+        )
+    ''')
+    conn.execute(f"""
+        INSERT INTO experience_cards (type, experience_id, first_name, last_name, user_email, user_phone, class_year, university_name, city, country, continent,
+                                      website, department_website, duration, tuition_cost, courses, finances, housings, entry_regulations, vaccinations)
+        SELECT 'study', e.id, u.first_name, u.last_name, u.user_email, u.user_phone, u.class_year, uni.name, uni.city, uni.country, uni.continent,
+               uni.website, uni.department_website, e.duration, e.tuition_cost,
+               {child_json(conn, 'courses', 'study_experience_id')},
+               {child_json(conn, 'finances', 'study_experience_id')},
+               {child_json(conn, 'housings', 'study_experience_id')},
+               {child_json(conn, 'entry_regulations', 'study_experience_id')},
+               {child_json(conn, 'vaccinations', 'study_experience_id')}
+        FROM study_experiences e
+        LEFT JOIN users u ON e.user_id = u.id
+        LEFT JOIN universities uni ON e.university_id = uni.id
+        ORDER BY e.id
+    """)
+    conn.execute(f"""
+        INSERT INTO experience_cards (type, experience_id, first_name, last_name, user_email, user_phone, class_year, organisation_name, city, country, continent,
+                                      duration, topic, work_description, other_tasks, supervisor_rating, organization_rating, comments,
+                                      internship_website, internship_contact_person, internship_contact_email, courses, finances, housings, entry_regulations, vaccinations)
+        SELECT 'internship', e.id, u.first_name, u.last_name, u.user_email, u.user_phone, u.class_year, o.name, o.city, o.country, o.continent,
+               e.duration, e.topic, e.work_description, e.other_tasks, e.supervisor_rating, e.organization_rating, e.comments,
+               e.internship_website, e.internship_contact_person, e.internship_contact_email, '[]',
+               {child_json(conn, 'finances', 'internship_experience_id')},
+               {child_json(conn, 'housings', 'internship_experience_id')},
+               {child_json(conn, 'entry_regulations', 'internship_experience_id')},
+               {child_json(conn, 'vaccinations', 'internship_experience_id')}
+        FROM internship_experiences e
+        LEFT JOIN users u ON e.user_id = u.id
+        LEFT JOIN organisations o ON e.organisation_id = o.id
+        ORDER BY e.id
+    """)
+    conn.commit()
+
+def text_of(*expressions):
+    return " || ' ' || ".join(f"IFNULL({expression}, '')" for expression in expressions)
+
+def create_search_index(conn):
+    # Contentless FTS5 index over the free-text columns. The text itself stays
+    # in the experience tables; experience_search_docs maps each FTS rowid
+    # back to its experience. Returns False if SQLite lacks FTS5.
+    conn.execute("DROP TABLE IF EXISTS experience_search")
+    conn.execute("DROP TABLE IF EXISTS experience_search_docs")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE experience_search USING fts5(topic, description, courses, housing, finances, content='')")
+    except sqlite3.OperationalError as e:
+        logging.warning("Skipping the search index: %s", e)
+        return False
+    conn.execute('''
+        CREATE TABLE experience_search_docs (
+            id INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            experience_id INTEGER NOT NULL
+        )
+    ''')
+    conn.execute("INSERT INTO experience_search_docs (type, experience_id) SELECT 'study', id FROM study_experiences ORDER BY id")
+    conn.execute("INSERT INTO experience_search_docs (type, experience_id) SELECT 'internship', id FROM internship_experiences ORDER BY id")
+    conn.execute(f"""
+        INSERT INTO experience_search (rowid, courses, housing, finances)
+        SELECT d.id,
+               (SELECT group_concat({text_of('c.title', 'c.comments')}, ' ') FROM courses c WHERE {STUDY_COURSES}),
+               (SELECT group_concat(c.comments, ' ') FROM housings c WHERE c.study_experience_id = e.id),
+               (SELECT group_concat(c.comments, ' ') FROM finances c WHERE c.study_experience_id = e.id)
+        FROM experience_search_docs d JOIN study_experiences e ON e.id = d.experience_id
+        WHERE d.type = 'study'
+    """)
+    conn.execute(f"""
+        INSERT INTO experience_search (rowid, topic, description, housing, finances)
+        SELECT d.id, e.topic, {text_of('e.work_description', 'e.other_tasks', 'e.comments')},
+               (SELECT group_concat(c.comments, ' ') FROM housings c WHERE c.internship_experience_id = e.id),
+               (SELECT group_concat(c.comments, ' ') FROM finances c WHERE c.internship_experience_id = e.id)
+        FROM experience_search_docs d JOIN internship_experiences e ON e.id = d.experience_id
+        WHERE d.type = 'internship'
+    """)
+    # Merge the segments written during the bulk insert into one b-tree
+    conn.execute("INSERT INTO experience_search (experience_search) VALUES ('optimize')")
+    conn.commit()
+    return True
+
+def search_query(text):
+    # Turns user input into an FTS5 query: every word is a quoted prefix term
+    return ' '.join('"' + word.replace('"', '""') + '"*' for word in text.split())
+
+def search_experiences(conn, text, limit=20):
+    # Returns (type, experience_id) pairs, best bm25 match first
+    return conn.execute("""
+        SELECT d.type, d.experience_id FROM experience_search s
+        JOIN experience_search_docs d ON d.id = s.rowid
+        WHERE experience_search MATCH ? ORDER BY rank LIMIT ?
+    """, (search_query(text), limit)).fetchall()
+
+TABLES = ['users', 'universities', 'organisations', 'study_experiences', 'internship_experiences', 'courses', 'finances', 'entry_regulations', 'housings', 'vaccinations']
+
+# Source tables fingerprinted for --incremental, with the column that ties
+# their rows to a student, or to the university (courses) or internship (work
+# descriptions) they belong to. Lookup tables have no key.
+FINGERPRINT_TABLES = dict([('tblStudenten', 'Student_ID'), ('tblUniversität', 'Student_ID'), ('tblPraktikumsort', 'Student_ID')]
+                          + list(CHILD_TABLES.values())
+                          + [(table, None) for table, _, _ in LOOKUP_TABLES.values()])
+
+def create_manifest_tables(conn):
+    cursor = conn.cursor()
+    # source_key has no type so keys keep the type they have in the source
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS migration_fingerprints (
+            source_table TEXT NOT NULL,
+            source_key,
+            fingerprint TEXT NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS migration_fingerprints_key ON migration_fingerprints (source_table, source_key)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS migration_manifest (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            migrated_at TEXT NOT NULL,
+            source TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            rows_inserted INTEGER,
+            rows_changed INTEGER,
+            rows_deleted INTEGER,
+            students_migrated INTEGER
+        )
+    ''')
+
+def row_fingerprint(values):
+    return hashlib.blake2b(repr(tuple(values)).encode(), digest_size=16).hexdigest()
+
+def source_fingerprints(conn, table, key_column, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Fingerprints of the current source rows, grouped by key
+    fingerprints = {}
+    try:
+        for rows in iter_chunks(conn, f"SELECT {key_column or 'NULL'}, * FROM {table}", chunk_size):
+            for row in rows:
+                fingerprints.setdefault(row[0], []).append(row_fingerprint(row[1:]))
+    except sqlite3.OperationalError:
+        # Missing tables (e.g. lookup tables) just have no rows
+        pass
+    return fingerprints
+
+def stored_fingerprints(conn, table):
+    fingerprints = {}
+    for key, fingerprint in conn.execute("SELECT source_key, fingerprint FROM migration_fingerprints WHERE source_table = ?", (table,)):
+        fingerprints.setdefault(key, []).append(fingerprint)
+    return fingerprints
+
+def diff_fingerprints(old, new):
+    # Returns the keys whose rows differ, and how many rows were inserted,
+    # changed or deleted. A row that disappeared and one that appeared under
+    # the same key count as one changed row.
+    keys = set()
+    counts = Counter()
+    for key in old.keys() | new.keys():
+        old_rows, new_rows = Counter(old.get(key, ())), Counter(new.get(key, ()))
+        if old_rows == new_rows:
+            continue
+        keys.add(key)
+        added, removed = sum((new_rows - old_rows).values()), sum((old_rows - new_rows).values())
+        counts['changed'] += min(added, removed)
+        counts['inserted'] += added - min(added, removed)
+        counts['deleted'] += removed - min(added, removed)
+    return keys, counts
+
+def save_fingerprints(conn, table, fingerprints, keys=None):
+    # Replaces the stored fingerprints of the given keys (all keys if None)
+    if keys is None:
+        conn.execute("DELETE FROM migration_fingerprints WHERE source_table = ?", (table,))
+        keys = fingerprints.keys()
+    else:
+        conn.executemany("DELETE FROM migration_fingerprints WHERE source_table = ? AND source_key IS ?", [(table, key) for key in keys])
+    conn.executemany("INSERT INTO migration_fingerprints (source_table, source_key, fingerprint) VALUES (?, ?, ?)",
+                     [(table, key, fingerprint) for key in keys for fingerprint in fingerprints.get(key, ())])
+
+def record_migration(conn, source_path, mode, counts, students_migrated):
+    conn.execute("INSERT INTO migration_manifest (migrated_at, source, mode, rows_inserted, rows_changed, rows_deleted, students_migrated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                 (datetime.now().isoformat(timespec='seconds'), source_path, mode, counts['inserted'], counts['changed'], counts['deleted'], students_migrated))
+
+def record_full_migration(source_conn, dest_conn, source_path, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Fingerprints every source row so the next --incremental run has a baseline
+    create_manifest_tables(dest_conn)
+    counts = Counter()
+    for table, key_column in FINGERPRINT_TABLES.items():
+        fingerprints = source_fingerprints(source_conn, table, key_column, chunk_size)
+        counts['inserted'] += sum(len(rows) for rows in fingerprints.values())
+        save_fingerprints(dest_conn, table, fingerprints)
+    students = dest_conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    record_migration(dest_conn, source_path, 'full', counts, students)
+
+def json_param(values):
+    # For "numeric_value(column) IN (SELECT value FROM json_each(?))" on the
+    # source, or an INTEGER column of the destination. Keys are compared by
+    # their numeric value, like the destination stores them, so a student is
+    # selected whatever the type of Student_ID in the table that changed.
+    return json.dumps(sorted({numeric_value(value) for value in values}, key=repr))
+
+def students_of(source_conn, dest_conn, table, key_column, keys):
+    # Students whose migrated rows depend on a course (Uni_ID) or work
+    # description (Praktikums_ID) key, before and after the change
+    dest_table, dest_column = ('study_experiences', 'university_id') if key_column == 'Uni_ID' else ('internship_experiences', 'organisation_id')
+    params = (json_param(keys),)
+    students = {row[0] for row in source_conn.execute(f"SELECT Student_ID FROM {table} WHERE numeric_value({key_column}) IN (SELECT value FROM json_each(?))", params)}
+    students |= {row[0] for row in dest_conn.execute(f"SELECT user_id FROM {dest_table} WHERE {dest_column} IN (SELECT value FROM json_each(?))", params)}
+    return students
+
+def delete_students(dest_conn, student_ids):
+    # Removes everything migrated for these students and returns the
+    # university and organisation ids they referenced
+    cursor = dest_conn.cursor()
+    cursor.execute("CREATE TEMP TABLE dirty_students (id PRIMARY KEY)")
+    cursor.executemany("INSERT INTO temp.dirty_students (id) VALUES (?)", [(student_id,) for student_id in student_ids])
+    universities = {row[0] for row in cursor.execute("SELECT DISTINCT university_id FROM study_experiences WHERE user_id IN (SELECT id FROM temp.dirty_students)")}
+    organisations = {row[0] for row in cursor.execute("SELECT DISTINCT organisation_id FROM internship_experiences WHERE user_id IN (SELECT id FROM temp.dirty_students)")}
+    for table in ('courses', 'finances', 'entry_regulations', 'housings', 'vaccinations'):
+        cursor.execute(f"DELETE FROM {table} WHERE study_experience_id IN (SELECT id FROM study_experiences WHERE user_id IN (SELECT id FROM temp.dirty_students))")
+        if table != 'courses':
+            cursor.execute(f"DELETE FROM {table} WHERE internship_experience_id IN (SELECT id FROM internship_experiences WHERE user_id IN (SELECT id FROM temp.dirty_students))")
+    cursor.execute("DELETE FROM study_experiences WHERE user_id IN (SELECT id FROM temp.dirty_students)")
+    cursor.execute("DELETE FROM internship_experiences WHERE user_id IN (SELECT id FROM temp.dirty_students)")
+    cursor.execute("DELETE FROM users WHERE id IN (SELECT id FROM temp.dirty_students)")
+    cursor.execute("DROP TABLE temp.dirty_students")
+    return universities, organisations
+
+def refresh_entities(source_conn, dest_conn, student_ids, universities, organisations):
+    # Universities and organisations are shared between students and come
+    # from the first source row with their id, so the ones the changed
+    # students referenced before or reference now are rebuilt from the source
+    params = (json_param(student_ids),)
+    universities |= {row[0] for row in source_conn.execute("SELECT CAST(Uni_ID AS INTEGER) FROM tblUniversität WHERE numeric_value(Student_ID) IN (SELECT value FROM json_each(?))", params)}
+    organisations |= {row[0] for row in source_conn.execute("SELECT Praktikums_ID FROM tblPraktikumsort WHERE numeric_value(Student_ID) IN (SELECT value FROM json_each(?))", params)}
+    dest_conn.execute("DELETE FROM universities WHERE id IN (SELECT value FROM json_each(?))", (json_param(universities),))
+    dest_conn.execute("DELETE FROM organisations WHERE id IN (SELECT value FROM json_each(?))", (json_param(organisations),))
+    rows = source_conn.execute("""SELECT * FROM tblUniversität WHERE rowid IN (SELECT MIN(rowid) FROM tblUniversität GROUP BY Uni_ID)
+                                  AND CAST(Uni_ID AS INTEGER) IN (SELECT value FROM json_each(?))""", (json_param(universities),))
+    dest_conn.executemany(INSERT_UNIVERSITY, [university_values(row, int(row['Uni_ID'])) for row in rows])
+    lookups = load_lookups(source_conn)
+    rows = source_conn.execute("""SELECT * FROM tblPraktikumsort WHERE rowid IN (SELECT MIN(rowid) FROM tblPraktikumsort GROUP BY Praktikums_ID)
+                                  AND numeric_value(Praktikums_ID) IN (SELECT value FROM json_each(?))""", (json_param(organisations),))
+    dest_conn.executemany(INSERT_ORGANISATION, [(row['Praktikums_ID'], row['NameOrganisation'], row['OrtPraktikum'], *organisation_location(row, lookups)) for row in rows])
+
+def migrate_incremental(source_conn, dest_conn, source_path, batch_size=DEFAULT_BATCH_SIZE, chunk_size=DEFAULT_CHUNK_SIZE, metrics=None):
+    # Applies only the source rows that changed since the last run, in a
+    # single transaction. Returns False if a full rebuild is needed instead.
+    has_manifest = dest_conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ('migration_fingerprints', 'users')").fetchone()[0] == 2
+    if not has_manifest:
+        logging.info("No migration manifest found, running a full migration")
+        return False
+    source_conn.create_function('numeric_value', 1, numeric_value, deterministic=True)
+
+    changed_keys = {}
+    new_fingerprints = {}
+    counts = Counter()
+    for table, key_column in FINGERPRINT_TABLES.items():
+        fingerprints = source_fingerprints(source_conn, table, key_column, chunk_size)
+        keys, table_counts = diff_fingerprints(stored_fingerprints(dest_conn, table), fingerprints)
+        if keys:
+            if key_column is None:
+                logging.info("Lookup table %s changed, running a full migration", table)
+                return False
+            changed_keys[table] = keys
+            new_fingerprints[table] = fingerprints
+            counts.update(table_counts)
+
+    student_ids = set()
+    for table, keys in changed_keys.items():
+        key_column = FINGERPRINT_TABLES[table]
+        if key_column == 'Student_ID':
+            student_ids |= keys
+        elif key_column == 'Uni_ID':
+            student_ids |= students_of(source_conn, dest_conn, 'tblUniversität', key_column, keys)
+        else:
+            student_ids |= students_of(source_conn, dest_conn, 'tblPraktikumsort', key_column, keys)
+    # Source tables may disagree on the type of Student_ID
+    student_ids = {numeric_value(student_id) for student_id in student_ids if student_id is not None}
+
+    if student_ids:
+        universities, organisations = delete_students(dest_conn, student_ids)
+        refresh_entities(source_conn, dest_conn, student_ids, universities, organisations)
+        migrate_python(source_conn, dest_conn, batch_size, chunk_size, student_ids=student_ids, metrics=metrics)
+    for table, keys in changed_keys.items():
+        save_fingerprints(dest_conn, table, new_fingerprints[table], keys)
+    # Not committed here: the caller's checkpoint commits the update and
+    # marks it applied in one transaction
+    record_migration(dest_conn, source_path, 'incremental', counts, len(student_ids))
+
+    logging.info("Incremental migration: %d inserted, %d changed, %d deleted source rows, %d students migrated",
+                 counts['inserted'], counts['changed'], counts['deleted'], len(student_ids))
+    print(f"Incremental migration: {counts['inserted']} inserted, {counts['changed']} changed, {counts['deleted']} deleted source rows, "
+          f"{len(student_ids)} students migrated")
+    return True
+
+# Columns the viewer never shows, cleared in --export files. They are set to
+# NULL rather than dropped because the viewer reads child rows by position.
+EXPORT_TRIMMED_COLUMNS = {
+    'universities': ['department'],
+    'study_experiences': ['study_fees'],
+    'finances': ['finance_institution_city', 'finance_institution_website', 'finance_institution_email'],
+    'entry_regulations': ['embassy_email', 'embassy_phone'],
+}
+# The viewer never reads the migration bookkeeping
+EXPORT_DROPPED_TABLES = ['migration_fingerprints', 'migration_manifest']
+DEFAULT_EXPORT_PAGE_SIZE = 8192
+
+def has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+def copy_database(source_path, copy_path):
+    source, copy = sqlite3.connect(source_path), get_db_connection(copy_path)
+    try:
+        source.backup(copy)
+    finally:
+        source.close()
+    return copy
+
+def experience_continents(conn):
+    # Continent of every study and internship experience, NULL if unknown
+    return [row[0] for row in conn.execute("""
+        SELECT (SELECT continent FROM universities WHERE id = e.university_id) FROM study_experiences e
+        UNION
+        SELECT (SELECT continent FROM organisations WHERE id = e.organisation_id) FROM internship_experiences e
+    """)]
+
+def keep_continent(conn, continent):
+    # Deletes every experience outside continent, then the rows only they referenced
+    conn.execute("DELETE FROM study_experiences WHERE (SELECT continent FROM universities WHERE id = university_id) IS NOT ?", (continent,))
+    conn.execute("DELETE FROM internship_experiences WHERE (SELECT continent FROM organisations WHERE id = organisation_id) IS NOT ?", (continent,))
+    for table in ('courses', 'finances', 'entry_regulations', 'housings', 'vaccinations'):
+        conn.execute(f"DELETE FROM {table} WHERE study_experience_id NOT IN (SELECT id FROM study_experiences)")
+        if table != 'courses':
+            conn.execute(f"DELETE FROM {table} WHERE internship_experience_id NOT IN (SELECT id FROM internship_experiences)")
+    conn.execute("DELETE FROM universities WHERE id NOT IN (SELECT university_id FROM study_experiences WHERE university_id IS NOT NULL)")
+    conn.execute("DELETE FROM organisations WHERE id NOT IN (SELECT organisation_id FROM internship_experiences WHERE organisation_id IS NOT NULL)")
+    # Courses linked to a university by --dedupe
+    conn.execute("DELETE FROM courses WHERE study_experience_id IS NULL AND university_id NOT IN (SELECT id FROM universities)")
+    conn.execute("""DELETE FROM users WHERE id NOT IN (SELECT user_id FROM study_experiences WHERE user_id IS NOT NULL
+                                                      UNION SELECT user_id FROM internship_experiences WHERE user_id IS NOT NULL)""")
+
+def write_export(trimmed_path, export_path, page_size=DEFAULT_EXPORT_PAGE_SIZE, continent=None, shard=False):
+    # Writes a compacted copy of the trimmed database, limited to one
+    # continent for a shard. If the database has experience_cards, that is
+    # all the viewer reads, so the export keeps only the cards and the search
+    # index. Returns the number of study and internship experiences.
+    work_path = f'{export_path}.tmp'
+    remove_build(work_path)
+    conn = copy_database(trimmed_path, work_path)
+    try:
+        cards, search = has_table(conn, 'experience_cards'), has_table(conn, 'experience_search_docs')
+        if shard:
+            keep_continent(conn, continent)
+            if search:
+                create_search_index(conn)
+        if cards:
+            # Rebuilt so the JSON child rows are trimmed (and sharded) too
+            create_experience_cards(conn)
+        counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ('study_experiences', 'internship_experiences')}
+        if cards:
+            for table in TABLES:
+                conn.execute(f"DROP TABLE {table}")
+        # The statistics copied along still describe the full database
+        conn.execute("ANALYZE")
+        conn.commit()
+
+        if os.path.exists(export_path):
+            os.remove(export_path)
+        conn.isolation_level = None
+        conn.execute(f"PRAGMA page_size = {int(page_size)}")
+        conn.execute("VACUUM INTO ?", (export_path,))
+    finally:
+        conn.close()
+        remove_build(work_path)
+    return counts
+
+def shard_name(continent):
+    # File name part for a continent, e.g. 'Nord Amerika' -> 'nord-amerika'
+    words = ''.join(c if c.isalnum() else ' ' for c in continent or '').lower().split()
+    return '-'.join(words) or 'unknown'
+
+def export_database(dest_path, export_path, page_size=DEFAULT_EXPORT_PAGE_SIZE, shards=False):
+    # Writes a compact copy of a migrated database for the viewer, and with
+    # shards one file per continent next to it plus a JSON manifest
+    export_dir = os.path.dirname(os.path.abspath(export_path))
+    os.makedirs(export_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=export_dir) as tmp_dir:
+        trimmed_path = os.path.join(tmp_dir, 'trimmed.sqlite')
+        conn = copy_database(dest_path, trimmed_path)
+        try:
+            for table in EXPORT_DROPPED_TABLES:
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+            for table, columns in EXPORT_TRIMMED_COLUMNS.items():
+                conn.execute(f"UPDATE {table} SET {', '.join(f'{column} = NULL' for column in columns)}")
+            conn.commit()
+            continents = experience_continents(conn)
+        finally:
+            conn.close()
+
+        counts = write_export(trimmed_path, export_path, page_size)
+        logging.info("Exported %s (%d bytes)", export_path, os.path.getsize(export_path))
+        if not shards:
+            return None
+
+        stem, extension = os.path.splitext(export_path)
+        manifest = {'export': os.path.basename(export_path), 'page_size': page_size, **counts, 'shards': []}
+        names = set()
+        for continent in sorted(continents, key=lambda continent: (continent is None, continent or '')):
+            base_name = name = shard_name(continent)
+            # Continents like '??' and NULL both come out as 'unknown'
+            suffix = 2
+            while name in names:
+                name, suffix = f'{base_name}-{suffix}', suffix + 1
+            names.add(name)
+            shard_path = f'{stem}-{name}{extension}'
+            shard_counts = write_export(trimmed_path, shard_path, page_size, continent, shard=True)
+            manifest['shards'].append({'continent': continent, 'file': os.path.basename(shard_path), **shard_counts,
+                                       'size_bytes': os.path.getsize(shard_path)})
+            logging.info("Exported the %s shard to %s", continent or 'unknown', shard_path)
+
+    manifest_path = f'{stem}.json'
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    return manifest_path
+
+def source_row_counts(conn):
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+    return {table: conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in tables}
+
+def migrate(source_path, dest_path, engine='python', batch_size=DEFAULT_BATCH_SIZE, bulk_load=False, chunk_size=DEFAULT_CHUNK_SIZE, cards=False,
+            search=False, dedupe=False, incremental=False, workers=1, profile=None, restart=False, checkpoint_seconds=DEFAULT_CHECKPOINT_SECONDS,
+            export=None, export_page_size=DEFAULT_EXPORT_PAGE_SIZE, shards=False):
+    # Builds into dest_path + '.partial' with a checkpoint after every stage
+    # and renames it over dest_path at the end, so readers never see a
+    # half-built database. An interrupted run is resumed from its last
+    # checkpoint; restart discards it. Returns the Metrics of the run. With
+    # profile, the migrate stage runs under cProfile and the stats are
+    # written to that path. With export, a compact copy for the viewer is
+    # written to that path once the build is in place.
+    metrics = Metrics()
+    profiler = cProfile.Profile() if profile else None
+    build_path = f'{dest_path}.partial'
+    source_stat = os.stat(source_path)
+    options = {'source': os.path.abspath(source_path), 'source_size': source_stat.st_size, 'source_mtime': source_stat.st_mtime,
+               'engine': engine, 'dedupe': dedupe, 'incremental': incremental}
+    source_conn = get_db_connection(source_path)
+    dest_conn, progress = open_build(build_path, dest_path, options, restart, incremental, checkpoint_seconds)
+
+    if bulk_load:
+        set_pragmas(dest_conn, BULK_LOAD_PRAGMAS)
+
+    migrated = False
+    if incremental:
+        # Cards and a search index from an earlier run are rebuilt, whether the
+        # update is applied or falls back to a full rebuild that drops them.
+        # Recorded before anything is dropped, so a resumed run still knows.
+        if not progress.completed('existing_tables'):
+            existing = {'cards': has_table(dest_conn, 'experience_cards'), 'search': has_table(dest_conn, 'experience_search')}
+            progress.checkpoint('existing_tables', completed=True, details=json.dumps(existing))
+        existing = json.loads(progress.get('existing_tables')['details'])
+        cards = cards or existing['cards']
+        search = search or existing['search']
+        if progress.completed('incremental'):
+            migrated = progress.get('incremental')['details'] == 'applied'
+        else:
+            with metrics.stage('incremental', dest_conn):
+                if profiler:
+                    profiler.enable()
+                migrated = migrate_incremental(source_conn, dest_conn, source_path, batch_size, chunk_size, metrics)
+                if profiler:
+                    profiler.disable()
+            progress.checkpoint('incremental', completed=True, details='applied' if migrated else 'full')
+    if not migrated:
+        if not progress.completed('create_tables'):
+            with metrics.stage('create_tables', dest_conn):
+                # Drop existing tables to start fresh
+                cursor = dest_conn.cursor()
+                for table in TABLES + ['experience_cards', 'experience_search', 'experience_search_docs', 'migration_fingerprints', 'migration_manifest']:
+                    cursor.execute(f"DROP TABLE IF EXISTS {table}")
+                dest_conn.commit()
+
+                create_tables(dest_conn)
+            progress.checkpoint('create_tables', completed=True)
+
+        if not progress.completed('migrate'):
+            with metrics.stage('migrate', dest_conn):
+                if profiler:
+                    profiler.enable()
+                if engine == 'sql':
+                    # Every INSERT ... SELECT reads its source tables in full
+                    for table, count in source_row_counts(source_conn).items():
+                        metrics.read(table, count)
+                    migrate_sql(dest_conn, source_path, dedupe)
+                elif workers > 1:
+                    migrate_parallel(source_conn, dest_conn, source_path, workers, batch_size, chunk_size, dedupe, metrics, progress)
+                else:
+                    migrate_python(source_conn, dest_conn, batch_size, chunk_size, dedupe, metrics=metrics, progress=progress)
+                if profiler:
+                    profiler.disable()
+            with metrics.stage('commit', dest_conn):
+                progress.checkpoint('migrate', completed=True)
+        if incremental and not progress.completed('fingerprints'):
+            with metrics.stage('fingerprints', dest_conn):
+                record_full_migration(source_conn, dest_conn, source_path, chunk_size)
+            progress.checkpoint('fingerprints', completed=True)
+
+    if dedupe:
+        report_deduplication(source_conn, dest_conn)
+    if not progress.completed('indexes'):
+        with metrics.stage('indexes', dest_conn):
+            create_indexes(dest_conn)
+        progress.checkpoint('indexes', completed=True)
+    if cards and not progress.completed('cards'):
+        with metrics.stage('cards', dest_conn):
+            create_experience_cards(dest_conn)
+        progress.checkpoint('cards', completed=True)
+    if search and not progress.completed('search'):
+        with metrics.stage('search', dest_conn):
+            create_search_index(dest_conn)
+        progress.checkpoint('search', completed=True)
+    if bulk_load:
+        # These pragmas can't be changed inside a transaction, so the safe
+        # settings are restored at the end; the file is synced before the rename
+        set_pragmas(dest_conn, SAFE_PRAGMAS)
     source_conn.close()
-    dest_conn.close()
+    finish_build(dest_conn, build_path, dest_path)
+
+    if export:
+        dest_conn = get_db_connection(dest_path)
+        with metrics.stage('export', dest_conn):
+            manifest_path = export_database(dest_path, export, export_page_size, shards)
+        dest_conn.close()
+        print(f"Exported the database for the viewer to {export}")
+        if manifest_path:
+            print(f"Wrote the continent shards listed in {manifest_path}")
+
+    if profiler:
+        profiler.dump_stats(profile)
+        logging.info("Wrote the profile of the migrate stage to %s", profile)
+    metrics.log()
+    return metrics
+
+def report_deduplication(source_conn, dest_conn):
+    # Compares the deduplicated row counts with what a plain migration writes
+    removed = {
+        'universities': source_conn.execute("SELECT COUNT(DISTINCT CAST(Uni_ID AS INTEGER)) FROM tblUniversität").fetchone()[0]
+                        - dest_conn.execute("SELECT COUNT(*) FROM universities").fetchone()[0],
+        'organisations': source_conn.execute("SELECT COUNT(DISTINCT Praktikums_ID) FROM tblPraktikumsort").fetchone()[0]
+                         - dest_conn.execute("SELECT COUNT(*) FROM organisations").fetchone()[0],
+        'courses': source_conn.execute("SELECT COUNT(*) FROM tblUniversität u JOIN tblKurse k ON k.Uni_ID = +u.Uni_ID").fetchone()[0]
+                   - dest_conn.execute("SELECT COUNT(*) FROM courses").fetchone()[0],
+    }
+    for table, count in removed.items():
+        logging.info("Deduplication removed %d rows from %s", count, table)
+        print(f"Deduplication removed {count} rows from {table}")
+    return removed
+
+# Child columns that reference an experience, and the table they point to
+EXPERIENCE_REFERENCES = {'study_experience_id': 'study_experiences', 'internship_experience_id': 'internship_experiences'}
+
+def table_rows(conn, table, ignore_ids=False):
+    # Rows of a migrated table in a comparable order. With ignore_ids, the
+    # experience and child row ids are left out and references to an
+    # experience are replaced by its columns, since an incremental run gives
+    # remigrated experiences new ids. Users, universities and organisations
+    # keep their source ids either way.
+    if not ignore_ids or table in ('users', 'universities', 'organisations'):
+        return conn.execute(f"SELECT * FROM {table} ORDER BY id").fetchall()
+    experiences = {name: {row[0]: row[1:] for row in conn.execute(f"SELECT * FROM {name}")} for name in EXPERIENCE_REFERENCES.values()}
+    cursor = conn.execute(f"SELECT * FROM {table}")
+    columns = [description[0] for description in cursor.description]
+    rows = []
+    for row in cursor:
+        rows.append(tuple(experiences[EXPERIENCE_REFERENCES[column]].get(value) if column in EXPERIENCE_REFERENCES and value is not None else value
+                          for column, value in zip(columns, row) if column != 'id'))
+    return sorted(rows, key=repr)
+
+def compare_databases(path_a, path_b, ignore_ids=False):
+    # Returns the tables whose rows differ between two migrated databases
+    conn_a, conn_b = sqlite3.connect(path_a), sqlite3.connect(path_b)
+    try:
+        return [table for table in TABLES if table_rows(conn_a, table, ignore_ids) != table_rows(conn_b, table, ignore_ids)]
+    finally:
+        conn_a.close()
+        conn_b.close()
+
+def verify(args):
+    logging.info("Verifying against the Python engine")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reference_path = os.path.join(tmp_dir, 'reference.sqlite')
+        migrate(args.source, reference_path, 'python', args.batch_size, chunk_size=args.chunk_size, dedupe=args.dedupe)
+        # Only the content can match after an incremental run, not the ids
+        return compare_databases(args.dest, reference_path, ignore_ids=args.incremental)
+
+def peak_memory_mib():
+    # Peak resident set size of this process, None where resource is unavailable
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Migrate the Access-derived abroad database to the new SQLite schema.')
+    parser.add_argument('--source', default='databases/data.sqlite', help='source database exported from Access')
+    parser.add_argument('--dest', default='abroad_experiences_migrated.sqlite', help='database to write the migrated data to')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='number of rows buffered before they are written')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='number of source rows read and transformed at a time')
+    parser.add_argument('--engine', choices=['python', 'sql'], default='python', help='migrate row by row in Python, or with set-based INSERT ... SELECT statements on an attached source')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes that transform source rows for the python engine (default 1, no pool)')
+    parser.add_argument('--dedupe', action='store_true', help='merge universities and organisations with the same name, city and country, and link courses once per university')
+    parser.add_argument('--incremental', action='store_true', help='only migrate source rows that changed since the last --incremental run (the first run is a full migration)')
+    parser.add_argument('--cards', action='store_true', help='also write the experience_cards table the viewer can load with a single query')
+    parser.add_argument('--search', action='store_true', help='also build a full-text search index over the free-text columns (needs FTS5)')
+    parser.add_argument('--verify', action='store_true', help='also run the Python engine into a temporary file and compare the results')
+    parser.add_argument('--export', metavar='PATH', help='also write a compacted copy for the viewer to PATH, without the columns it never shows')
+    parser.add_argument('--export-page-size', type=int, default=DEFAULT_EXPORT_PAGE_SIZE, help='page size of the --export files (default 8192)')
+    parser.add_argument('--shards', action='store_true', help='with --export, also write one file per continent and a JSON manifest next to PATH')
+    parser.add_argument('--restart', action='store_true', help='discard the checkpoints of an interrupted migration instead of resuming it')
+    parser.add_argument('--metrics', metavar='PATH', help='write the per-stage timings, row counts and fallback counts to PATH as JSON')
+    parser.add_argument('--profile', metavar='PATH', help='run the migrate stage under cProfile and write the stats to PATH')
+    parser.add_argument('--bulk-load', action='store_true', help='relax journaling and syncing while loading, safe settings are restored before the final commit')
+    args = parser.parse_args(argv)
+    if args.batch_size < 1:
+        parser.error('--batch-size must be at least 1')
+    if args.chunk_size < 1:
+        parser.error('--chunk-size must be at least 1')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.workers > 1 and args.engine == 'sql':
+        parser.error('--workers only applies to the python engine')
+    if args.shards and not args.export:
+        parser.error('--shards needs --export')
+    if args.incremental and args.dedupe:
+        parser.error('--incremental cannot be combined with --dedupe')
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        metrics = migrate(args.source, args.dest, engine=args.engine, batch_size=args.batch_size, bulk_load=args.bulk_load,
+                          chunk_size=args.chunk_size, cards=args.cards, search=args.search, dedupe=args.dedupe, incremental=args.incremental,
+                          workers=args.workers, profile=args.profile, restart=args.restart, export=args.export,
+                          export_page_size=args.export_page_size, shards=args.shards)
+    except KeyboardInterrupt:
+        logging.warning("Migration interrupted")
+        sys.exit(f"Interrupted. Run the same command again to resume from the last checkpoint in {args.dest}.partial")
     print("Database migrated successfully!")
+    stages = ', '.join(f"{name} {stage['seconds']:.2f}s" for name, stage in metrics.stages.items())
+    print(f"Stages: {stages}")
+    peak_memory = peak_memory_mib()
+    if peak_memory is not None:
+        logging.info("Peak memory: %.1f MiB", peak_memory)
+        print(f"Peak memory: {peak_memory:.1f} MiB")
+    if args.metrics:
+        summary = metrics.summary()
+        summary['peak_memory_mib'] = peak_memory
+        with open(args.metrics, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if args.verify:
+        differences = verify(args)
+        if differences:
+            logging.error("Verification against the Python engine failed for: %s", ', '.join(differences))
+            sys.exit(f"Verification failed, tables differ: {', '.join(differences)}")
+        print("Verified against the Python engine.")
 
 if __name__ == '__main__':
     main()